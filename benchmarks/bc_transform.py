@@ -0,0 +1,74 @@
+import sys
+import json
+from os.path import abspath, join, dirname
+project_dir = abspath(join(dirname(__file__), '..'))
+bc_dir = join(project_dir, 'projects', 'Business Central')
+sys.path.insert(0, bc_dir)
+
+from timeit import repeat
+from numpy.random import default_rng
+from transform import RecordTransformer, transform_record
+
+
+def build_sales_header_page(fields, rows):
+
+    #registros sinteticos con la forma de la respuesta de SQLSalesHeader: cada campo con apply_null_format
+    #recibe su valor vacio en una parte de las filas, y cada registro incluye la anotacion @odata.etag
+
+    rng = default_rng(0)
+
+    samples = {
+
+        'str' : ['ABC', '', ' ', 'MXN'],
+        'int' : [0, 1, 25, 3],
+        'date' : ['2024-01-31', '0001-01-01'],
+        'bool' : [True, False]
+    }
+
+    records = []
+
+    for _ in range(rows):
+
+        record = {'@odata.etag' : 'W/"JzQ0OzEn"'}
+
+        for attr in fields.values():
+
+            values = samples.get(attr['type'], [1.5])
+
+            record[attr['endpoint_field']] = values[rng.integers(len(values))]
+
+        records.append(record)
+
+    return records
+
+
+if __name__ == '__main__':
+
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    with open(join(bc_dir, 'db_schema.json'), 'r') as file:
+
+        fields = json.load(file)['tables']['SalesHeader']['fields']
+
+    page = build_sales_header_page(fields, rows)
+
+    transformer = RecordTransformer(fields)
+
+    #se comparan solo las columnas del esquema: transform_record conserva las anotaciones de OData como @odata.etag
+
+    assert [{k : r[k] for k in fields} for r in (transform_record(_, fields) for _ in page)] == transformer.transform_page(page)
+
+    assert transformer.to_frame(page).to_dict('records') == transformer.transform_page(page)
+
+    cases = [
+
+        ('transform_record', lambda: [transform_record(_, fields) for _ in page]),
+        ('RecordTransformer.transform_page', lambda: transformer.transform_page(page)),
+        ('RecordTransformer.to_frame', lambda: transformer.to_frame(page))
+    ]
+
+    for name, fn in cases:
+
+        best = min(repeat(fn, number=1, repeat=3))
+
+        print(f'{name:<36} {rows} registros x {len(fields)} campos: {best:.3f} s')
@@ -0,0 +1,65 @@
+import sys
+from os.path import abspath, join, dirname
+project_dir = abspath(join(dirname(__file__), '..'))
+sys.path.insert(0, project_dir)
+
+from timeit import repeat
+from numpy import nan
+from numpy.random import default_rng
+from pandas import DataFrame
+from utils.utilities import set_null_values, normalize_null_values
+
+
+def build_pointofsale_frame(rows):
+
+    #DataFrame sintetico con la forma de la tabla PointOfSale: enteros, textos con cadenas vacias,
+    #coordenadas con NaN y columnas anidadas que llegan como diccionarios
+
+    rng = default_rng(0)
+
+    names = rng.choice(['tienda', '', 'farmacia', None], size=rows)
+    latitudes = rng.uniform(14, 32, size=rows)
+    latitudes[rng.random(rows) < 0.2] = nan
+
+    return DataFrame({
+
+        'id' : range(rows),
+        'pointOfSaleBaseId' : range(rows),
+        'name' : names,
+        'code' : rng.choice(['A1', '', 'B2'], size=rows),
+        'enabled' : rng.random(rows) < 0.9,
+        'region_id' : rng.integers(1, 50, size=rows),
+        'chain_id' : rng.choice([1.0, 2.0, nan], size=rows),
+        'pointOfSaleType_id' : rng.choice([1.0, nan], size=rows),
+        'pointOfSaleProfile_id' : rng.choice([3.0, nan], size=rows),
+        'pointOfSaleChannel_id' : rng.integers(1, 5, size=rows),
+        'address_zipCode' : rng.choice(['01000', '', '64000'], size=rows),
+        'address_city_name' : rng.choice([{}, 'Monterrey', 'CDMX'], size=rows),
+        'address_city_state_name' : rng.choice([{}, 'Nuevo Leon', ''], size=rows),
+        'address_latitude' : latitudes,
+        'address_longitude' : rng.uniform(-117, -86, size=rows),
+        'deleted' : rng.random(rows) < 0.05,
+        'storeNumber' : rng.choice(['', '12', '15'], size=rows)
+    })
+
+
+def current_path(df):
+
+    return df.map(set_null_values).replace({nan:None})
+
+
+if __name__ == '__main__':
+
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    df = build_pointofsale_frame(rows)
+
+    #se comparan valores: replace({nan:None}) convierte a object todas las columnas float, incluso sin NaN
+
+    assert current_path(df).astype(object).equals(normalize_null_values(df).astype(object))
+
+    for name, fn in [('map(set_null_values).replace', current_path), ('normalize_null_values', normalize_null_values)]:
+
+        best = min(repeat(lambda: fn(df), number=1, repeat=3))
+
+        print(f'{name:<32} {rows} filas x {len(df.columns)} columnas: {best:.3f} s')
@@ -0,0 +1,80 @@
+import sys
+from os.path import abspath, join, dirname
+project_dir = abspath(join(dirname(__file__), '..'))
+sys.path.insert(0, project_dir)
+
+from io import BytesIO
+from timeit import repeat
+from numpy.random import default_rng
+import pandas as pd
+from utils.utilities import read_visits_report
+
+
+def build_visits_report(rows):
+
+    #informe gerencial sintetico con las columnas del ambiente 1 y columnas adicionales que el flujo no usa,
+    #con fechas como texto en el formato de Involves y celdas vacias en los check-in y motivos
+
+    rng = default_rng(0)
+
+    check_in = rng.choice(['01/02/2024 09:15:00', '01/02/2024 10:40:00', None], size=rows)
+
+    df = pd.DataFrame({
+
+        'Fecha de la visita' : rng.choice(['01/02/2024', '02/02/2024'], size=rows),
+        'ID del PDV' : rng.integers(1, 5000, size=rows).astype(str),
+        'Nombre del PDV' : rng.choice(['Farmacia Centro', 'Tienda Norte'], size=rows),
+        'Regional' : rng.choice(['Norte', 'Sur', None], size=rows),
+        'Empleado' : rng.choice(['Ana', 'Luis', 'Carla'], size=rows),
+        'Tipo de check-in' : rng.choice(['Manual', 'GPS', None], size=rows),
+        'Primer check-in manual' : check_in,
+        'Último check-out manual' : check_in,
+        'Total de encuestas respondidas' : rng.integers(0, 5, size=rows),
+        'Motivo para no realizar la visita' : rng.choice(['Cerrado', None], size=rows),
+        'Dirección' : rng.choice(['Av. Reforma 1', 'Calle 5 de Mayo 20'], size=rows),
+        'Ciudad' : rng.choice(['CDMX', 'Monterrey'], size=rows),
+        'Estado' : rng.choice(['CDMX', 'Nuevo Leon'], size=rows),
+        'Observaciones' : rng.choice(['', 'sin observaciones', None], size=rows)
+    })
+
+    buffer = BytesIO()
+
+    df.to_excel(buffer, index=False)
+
+    return buffer.getvalue()
+
+
+def current_path(content, env):
+
+    #lectura anterior: libro completo con read_excel y conversion columna por columna
+
+    df = pd.read_excel(BytesIO(content))
+    df['Fecha de la visita'] = pd.to_datetime(df['Fecha de la visita'],format="%d/%m/%Y").dt.date
+    df['ID del PDV'] = pd.to_numeric(df['ID del PDV'])
+    df['Regional'] = df['Regional'].astype(str)
+    df['Tipo de check-in'] = df['Tipo de check-in'].astype(str)
+    df['Primer check-in manual'] = pd.to_datetime(df['Primer check-in manual'],format='%d/%m/%Y %H:%M:%S',errors='coerce')
+    df['Último check-out manual'] = pd.to_datetime(df['Último check-out manual'],format='%d/%m/%Y %H:%M:%S',errors='coerce')
+
+    return df[['Fecha de la visita','ID del PDV','Empleado','Tipo de check-in','Primer check-in manual',
+               'Último check-out manual','Total de encuestas respondidas','Motivo para no realizar la visita']]
+
+
+if __name__ == '__main__':
+
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    content = build_visits_report(rows)
+
+    #se comparan valores: read_excel infiere tipos numericos en columnas sin conversion declarada
+
+    expected = current_path(content, 1)
+    result = read_visits_report(BytesIO(content), 1)
+
+    assert expected.astype(object).fillna(-1).equals(result.astype(object).fillna(-1))
+
+    for name, fn in [('read_excel + conversion', lambda: current_path(content, 1)), ('read_visits_report', lambda: read_visits_report(BytesIO(content), 1))]:
+
+        best = min(repeat(fn, number=1, repeat=3))
+
+        print(f'{name:<28} {rows} filas: {best:.3f} s')
@@ -1,38 +1,36 @@
 from prefect import flow
-from tasks import get_records, update_table_with_dicts
+from tasks import get_records, stream_records, update_table_with_dicts
 
 import sys
 import os
 import json
 import dotenv
+from collections import deque
+from graphlib import TopologicalSorter
 
 from src.business_central_api_client import BusinessCentralAPIClient
 from src.sql_engine import SQLServerEngine
+from src.checkpoint_store import CheckpointStore
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 
-project_dir = os.abspath(os.path.join(os.getcwd(), './'))
+project_dir = os.path.abspath(os.path.join(os.getcwd(), './'))
 
 sys.path.insert(0, project_dir)
 
 
 @flow(name='actualizacion BC_PROD SQL',log_prints=True)
 
-def update_bc_prod_db(tenant_id,environment,company,client_id,client_secret,server,database):
+def update_bc_prod_db(tenant_id,environment,company,client_id,client_secret,server,database,max_workers=4):
 
-    #setting an instance of BusinessCentralAPIClient for making the api calls.
-
-    APIClient = BusinessCentralAPIClient(tenant_id,
-                         environment,
-                         company,
-                         client_id,
-                         client_secret,
-                         )
-
-    #setting an instance of SQLServerEngine for performing SQL operations.
+    #setting an instance of SQLServerEngine for performing SQL operations, its connection pool gives each table task its own connection.
 
     Session = SQLServerEngine(server=server,
                              database=database)
+
+    #watermarks of the incremental extraction of each table
+
+    Checkpoints = CheckpointStore('business_central',environment,SQLSession=Session)
     
     
     #reading db_schema json which specifies configurations for each sql table
@@ -43,10 +41,25 @@ def update_bc_prod_db(tenant_id,environment,company,client_id,client_secret,serv
 
         db_schema = json.load(file)
 
+    #tables are submitted in dependency order ('depends_on' key of the schema), each table waits only for the tables it depends on,
+    #so the extraction of a table runs while others are still loading. at most max_workers tables are in flight at the same time.
+
+    order = TopologicalSorter({table : table_config.get('depends_on',[]) for table, table_config in db_schema['tables'].items()}).static_order()
+
+    futures = {}
+
+    in_flight = deque()
+
     #for each sql table defined on the json schema, obtain its corresponding endpoint, primary key, fields configuration and allowed operations
     #to perform the update.
 
-    for table, table_config in db_schema['tables'].items():
+    for table in order:
+
+        if table not in db_schema['tables']:
+
+            raise ValueError(f'La tabla {table} se declara como dependencia pero no existe en db_schema.json')
+
+        table_config = db_schema['tables'][table]
         
         endpoint = table_config['endpoint']
 
@@ -56,13 +69,46 @@ def update_bc_prod_db(tenant_id,environment,company,client_id,client_secret,serv
 
         allowed_ops = table_config['allowed_operations']
 
-        #get new and/or modified and/or deleted records from the endpoint depending on the allowed operations for the specific table.
+        #optional partitioning of the extraction into concurrent key ranges
+
+        partitions = table_config.get('partitions',1)
+
+        partition_key = table_config.get('partition_key')
+
+        dependencies = [futures[_] for _ in table_config.get('depends_on',[])]
+
+        #each table gets its own instance of BusinessCentralAPIClient (and connection pool), the access token is shared between them.
+
+        APIClient = BusinessCentralAPIClient(tenant_id,
+                             environment,
+                             company,
+                             client_id,
+                             client_secret,
+                             max_concurrency=table_config.get('max_concurrency',max(partitions,1))
+                             )
+
+        while len(in_flight) >= max_workers:
+
+            in_flight.popleft().wait()
+
+        if table_config.get('stream',True):
+
+            #records are transformed and written one page (and key range) at a time as they are retrieved.
+
+            futures[table] = stream_records.submit(Session,APIClient,Checkpoints,endpoint,table,fields_attr,allowed_ops,primary_key,
+                                                   partitions,partition_key,wait_for=dependencies)
+
+        else:
+
+            #get new and/or modified and/or deleted records from the endpoint depending on the allowed operations for the specific table.
+
+            data = get_records.submit(Session,APIClient,endpoint,table,fields_attr,allowed_ops,partitions,partition_key,wait_for=dependencies)
 
-        data = get_records.submit(Session,APIClient,endpoint,table,fields_attr,allowed_ops)
+            #update SQL table with three possible operations: insert, update and delete.
 
-        #update SQL table with three possible operations: insert, update and delete.
+            futures[table] = update_table_with_dicts.submit(Session,data,table,primary_key,wait_for=[data])
 
-        update_table_with_dicts.submit(Session,data,table,primary_key,wait_for=[data])
+        in_flight.append(futures[table])
 
 
 if __name__ == '__main__':
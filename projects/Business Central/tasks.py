@@ -1,21 +1,33 @@
 import sys
 import os
+import re
+from datetime import datetime
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 from pandas import DataFrame
 from prefect import task
 from prefect.artifacts import create_markdown_artifact
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
-project_dir = os.abspath(os.path.join(os.getcwd(), './'))
+project_dir = os.path.abspath(os.path.join(os.getcwd(), './'))
 
 sys.path.insert(0, project_dir)
 
 from src.business_central_api_client import BusinessCentralAPIClient
 from src.sql_engine import SQLServerEngine
+from src.checkpoint_store import CheckpointStore
+from transform import RecordTransformer
+
+#field used to resolve records retrieved more than once on the same run, the last modified version wins
+
+MODIFIED_AT = 'systemModifiedAt'
+
+CREATED_AT = 'systemCreatedAt'
 
 
 @task(log_prints=True, task_run_name='GET - {table}')
 def get_records(Session : SQLServerEngine,APIClient : BusinessCentralAPIClient,endpoint : str,table : str,
-                fields : dict,allowed_operations : dict) -> dict:
+                fields : dict,allowed_operations : dict,partitions : int = 1,partition_key : str = None) -> dict:
     
     #obtain last created record datetime and last modified record datetime from sql table, formated as ISO 8601 standard
     
@@ -27,33 +39,40 @@ def get_records(Session : SQLServerEngine,APIClient : BusinessCentralAPIClient,e
 
     columns = [_['endpoint_field'] for _ in fields.values()]
 
+    transformer = RecordTransformer(fields)
+
     records_to_insert = [] 
     
     records_to_update = []
 
     #make api calls using the following query parameters: $select to retrieve only required columns and 
     # $filter to fetch only records created and modified after last database update.
+    # when the table declares partitions on db_schema.json, the request is split into key ranges fetched concurrently.
 
     if allowed_operations['insert']:
 
-        data =  APIClient.get_with_odata_parameters(api_page=endpoint,createdAt=last_created_dt,select=columns)
+        data =  APIClient.get_with_odata_parameters(api_page=endpoint,createdAt=last_created_dt,select=columns,
+                                                    partitions=partitions,partition_key=partition_key)
 
         #set column names and apply custom null logic as specified on db_schema.json
 
-        records_to_insert = [transform_record(_, fields) for _ in data]
+        records_to_insert = transformer.transform_page(data)
 
     if allowed_operations['update']:
 
 
-        data =  APIClient.get_with_odata_parameters(api_page=endpoint,createdAt=last_modified_dt,select=columns)
+        data =  APIClient.get_with_odata_parameters(api_page=endpoint,modifiedAt=last_modified_dt,select=columns,
+                                                    partitions=partitions,partition_key=partition_key)
 
         #set column names and apply custom null logic as specified on db_schema.json
 
-        records_to_update = [transform_record(_, fields) for _ in data]
+        records_to_update = transformer.transform_page(data)
 
-        #filter out modified records that are also new records
+        #filter out modified records that are also new records, keeping the last modified version of each primary key
 
-        records_to_update = [_ for _ in records_to_update if _ not in records_to_insert]
+        primary_key = [k for k, v in fields.items() if v.get('primary_key')]
+
+        records_to_insert, records_to_update = reconcile_records(records_to_insert,records_to_update,primary_key)
 
 
         #return a dictionary containing the list of dictionaries to insert and to update on sql table.
@@ -63,6 +82,113 @@ def get_records(Session : SQLServerEngine,APIClient : BusinessCentralAPIClient,e
     return result
 
 
+@task(log_prints=True, task_run_name='GET/SQL - {table}')
+def stream_records(Session : SQLServerEngine,APIClient : BusinessCentralAPIClient,Checkpoints : CheckpointStore,endpoint : str,table : str,
+                   fields : dict,allowed_operations : dict,primary_key : list,partitions : int = 1,partition_key : str = None) -> dict:
+
+    #streaming version of get_records + update_table_with_dicts: each page of the api response is transformed and
+    #written to the sql table as soon as it arrives, so memory stays flat regardless of the number of records.
+    #when the table declares partitions on db_schema.json, each key range is streamed by its own worker.
+
+    columns = [_['endpoint_field'] for _ in fields.values()]
+
+    transformer = RecordTransformer(fields)
+
+    counts = {'insert' : 0, 'update' : 0}
+
+    #the watermarks are kept on the checkpoint store instead of MAX() over the table: records inserted by the insert pass
+    #carry recent modification timestamps and would move MAX(systemModifiedAt) past updates that were not applied yet.
+    #the first run seeds them from the table.
+
+    if allowed_operations['update']:
+
+        last_modified_dt = Checkpoints.get(f'{table}_modified') or format_timestamp(Session.get_last_update(table,MODIFIED_AT))
+
+        def update(rows):
+
+            write_records(SQLSession=Session,rows=rows,table=table,primary_key=primary_key,operation='update')
+
+        pages = APIClient.iter_record_partitions(api_page=endpoint,modifiedAt=last_modified_dt,orderBy=MODIFIED_AT,select=columns,
+                                                 partitions=partitions,partition_key=partition_key)
+
+        counts['update'], watermark = consume_pages(pages,transformer,update,MODIFIED_AT)
+
+        #the watermark only moves once every page of every key range is written, a failed run fetches the same records again
+        #and updates are idempotent.
+
+        if watermark:
+
+            Checkpoints.set(f'{table}_modified',watermark)
+
+    #the insert pass runs after the update pass so a record created and modified since the last run is inserted with its last version.
+    #rows fetched again after a failed run are upserted (or skipped when the table does not allow updates) instead of inserted twice.
+
+    if allowed_operations['insert']:
+
+        last_created_dt = Checkpoints.get(f'{table}_created') or format_timestamp(Session.get_last_update(table,CREATED_AT))
+
+        operation = 'upsert' if allowed_operations['update'] else 'insert_new'
+
+        def insert(rows):
+
+            write_records(SQLSession=Session,rows=rows,table=table,primary_key=primary_key,operation=operation)
+
+        pages = APIClient.iter_record_partitions(api_page=endpoint,createdAt=last_created_dt,orderBy=CREATED_AT,select=columns,
+                                                 partitions=partitions,partition_key=partition_key)
+
+        counts['insert'], watermark = consume_pages(pages,transformer,insert,CREATED_AT)
+
+        if watermark:
+
+            Checkpoints.set(f'{table}_created',watermark)
+
+    create_markdown_artifact(markdown=DataFrame([counts]).to_markdown(index=False),description=f'registros nuevos y actualizados {table}')
+
+    return counts
+
+
+def consume_pages(pages : list,transformer : RecordTransformer,write,watermark_field : str):
+
+    #consume one page iterator per key range concurrently, transforming and writing each page as it arrives.
+    #returns the number of records written and the highest value of watermark_field seen, as returned by the api.
+
+    lock = Lock()
+
+    state = {'count' : 0, 'watermark' : None}
+
+    def consume(iterator):
+
+        for page in iterator:
+
+            rows = transformer.transform_page(page)
+
+            write(rows)
+
+            highest = max((_[watermark_field] for _ in page if _.get(watermark_field)), key=parse_timestamp, default=None)
+
+            with lock:
+
+                state['count'] += len(rows)
+
+                if highest and (state['watermark'] is None or parse_timestamp(highest) > parse_timestamp(state['watermark'])):
+
+                    state['watermark'] = highest
+
+    if len(pages) == 1:
+
+        consume(pages[0])
+
+    else:
+
+        with ThreadPoolExecutor(max_workers=len(pages)) as executor:
+
+            for future in [executor.submit(consume, _) for _ in pages]:
+
+                future.result()
+
+    return state['count'], state['watermark']
+
+
 @task(name='actualizar tabla SQL',log_prints=True)
 def update_table_with_dicts(SQLSession : SQLServerEngine,dicts : dict,table : str,primary_key : list):
 
@@ -74,7 +200,7 @@ def update_table_with_dicts(SQLSession : SQLServerEngine,dicts : dict,table : st
 
         if rows:
 
-            SQLSession.bulk_insert_from_pydicts(pydict=rows,table_name=table)
+            write_records(SQLSession,rows,table,primary_key,'insert')
 
             markdown_table = DataFrame(rows).to_markdown(index=True)
 
@@ -97,7 +223,7 @@ def update_table_with_dicts(SQLSession : SQLServerEngine,dicts : dict,table : st
      
         if rows:
                
-            SQLSession.update_records_from_pydicts(table,rows,primary_key)
+            write_records(SQLSession,rows,table,primary_key,'update')
 
             markdown_table = DataFrame(rows).to_markdown(index=True)
 
@@ -112,42 +238,112 @@ def update_table_with_dicts(SQLSession : SQLServerEngine,dicts : dict,table : st
             print(f'No se encontraron registros modificados para actualizar en la tabla {table}')
 
 
+def reconcile_records(records_to_insert : list,records_to_update : list,primary_key : list):
+
+    #index both lists by primary key; a record present in both stays on the insert list with its last modified version,
+    #and duplicated keys within a list keep the last modified record, so the reconciliation is linear on the number of records.
+
+    inserts = {}
+
+    for _ in records_to_insert:
+
+        key = tuple(_[k] for k in primary_key)
+
+        if key not in inserts or not is_stale(_.get(MODIFIED_AT), inserts[key].get(MODIFIED_AT)):
+
+            inserts[key] = _
+
+    updates = {}
+
+    for _ in records_to_update:
+
+        key = tuple(_[k] for k in primary_key)
+
+        if key in inserts:
+
+            if not is_stale(_.get(MODIFIED_AT), inserts[key].get(MODIFIED_AT)):
+
+                inserts[key] = _
+
+        elif key not in updates or not is_stale(_.get(MODIFIED_AT), updates[key].get(MODIFIED_AT)):
+
+            updates[key] = _
+
+    return list(inserts.values()), list(updates.values())
 
-def transform_record(row : dict,fields : dict):
 
-    #for each dictionary which represents a row on the api response, rename, mapping the api fields to the sql table fields.
+def is_stale(modified_at, current_modified_at):
 
-    column_map = {v['endpoint_field']: k for k, v in fields.items()}
+    #True when a record modified at modified_at is not newer than the version already kept.
 
-    #custom mapping dictionaries, for certain columns as specified on db_schema.json, mapping empty values to None
-    # which is compatible with SQL NULL value
+    if modified_at is None or current_modified_at is None:
 
-    str_null_map = {'' : None,' ' : None}
+        return True
 
-    int_null_map = {0 : None}
+    return parse_timestamp(modified_at) <= parse_timestamp(current_modified_at)
 
-    date_null_map = { '0001-01-01' : None}
 
-    row = {column_map.get(k, k): v for k, v in row.items()}
+def format_timestamp(value):
 
-    #custom logic that iterates over dictionary values to set None for empty values.
+    #format a datetime as the ISO 8601 timestamp expected by the api filters, None (no filter) for an empty table.
 
-    for f, attr in fields.items():
+    if not value:
 
-        if attr['apply_null_format']:
+        return None
 
-            match attr['type']:
-                
-                case 'str':
+    return value.strftime('%Y-%m-%dT%H:%M:%S.%f')+'Z'
 
-                    row[f] = str_null_map.get(row[f], row[f])
 
-                case 'int':
+def parse_timestamp(value):
 
-                    row[f] = int_null_map.get(row[f], row[f])
+    #ISO 8601 timestamps from the api can't be compared as strings: OData trims trailing zeros of the fractional seconds
+    #(e.g. '10:00:00.5Z' and '10:00:00Z'). the fraction is padded to microseconds so fromisoformat accepts any precision.
 
-                case 'date':
+    if not isinstance(value, str):
 
-                    row[f] = date_null_map.get(row[f],row[f])
+        return value
 
-    return row
+    value = value.replace('Z', '+00:00')
+
+    match = re.match(r'^(.*?T\d{2}:\d{2}:\d{2})(?:\.(\d+))?(.*)$', value)
+
+    if match:
+
+        value = f"{match.group(1)}.{(match.group(2) or '').ljust(6, '0')[:6]}{match.group(3)}"
+
+    return datetime.fromisoformat(value)
+
+
+def write_records(SQLSession : SQLServerEngine,rows : list,table : str,primary_key : list,operation : str):
+
+    #write a batch of transformed records to the sql table, either inserting new records or updating existing ones by primary key.
+
+    if not rows:
+
+        return
+
+    if operation == 'insert':
+
+        SQLSession.bulk_insert_from_pydicts(pydict=rows,table_name=table)
+
+    elif operation == 'update':
+
+        SQLSession.update_records_from_pydicts(table,rows,primary_key)
+
+    elif operation == 'upsert':
+
+        SQLSession.upsert_from_df(table,DataFrame(rows),primary_key)
+
+    elif operation == 'insert_new':
+
+        #insert only the records whose primary key is not on the table yet
+
+        new = SQLSession.diff_from_df(table,DataFrame(rows),primary_key,compare=False)['insert']
+
+        new_keys = set(new[primary_key].itertuples(index=False,name=None))
+
+        rows = [_ for _ in rows if tuple(_[k] for k in primary_key) in new_keys]
+
+        if rows:
+
+            SQLSession.bulk_insert_from_pydicts(pydict=rows,table_name=table)
@@ -0,0 +1,113 @@
+from pandas import DataFrame
+
+
+#values mapped to None (compatible with SQL NULL value) for the columns with apply_null_format on db_schema.json, by column type
+
+NULL_VALUES = {
+
+    'str' : ('',' '),
+    'int' : (0,),
+    'date' : ('0001-01-01',)
+}
+
+
+class RecordTransformer:
+
+    """
+    Record transformer compiled once per table from the fields configuration of db_schema.json.
+
+    The rename pairs and the null rules of each column are computed on initialization, so transforming a row
+    is a single pass over the table fields instead of rebuilding the mappings and matching field types per row.
+    Rows returned contain only the fields declared on the schema.
+
+    Attributes:
+
+        fields (dict) : fields configuration of the table as declared on db_schema.json.
+        renames (tuple) : pairs of (endpoint field, sql column) for every field of the table.
+        null_rules (tuple) : pairs of (sql column, set of values mapped to None) for the fields with apply_null_format.
+    """
+
+    def __init__(self, fields):
+
+        self.fields = fields
+
+        self.renames = tuple((v['endpoint_field'], k) for k, v in fields.items())
+
+        self.null_rules = tuple(
+
+            (k, frozenset(NULL_VALUES[v['type']])) for k, v in fields.items()
+
+            if v['apply_null_format'] and v['type'] in NULL_VALUES
+        )
+
+    def __call__(self, row):
+
+        record = {column : row.get(field) for field, column in self.renames}
+
+        for column, null_values in self.null_rules:
+
+            if record[column] in null_values:
+
+                record[column] = None
+
+        return record
+
+    def transform_page(self, rows):
+
+        return [self(_) for _ in rows]
+
+    def to_frame(self, rows):
+
+        """
+        Columnar version of transform_page, returns a DataFrame with the sql columns of the table.
+        """
+
+        df = DataFrame(rows, columns=[field for field, _ in self.renames]).rename(columns=dict(self.renames))
+
+        for column, null_values in self.null_rules:
+
+            df[column] = df[column].astype(object).where(~df[column].isin(list(null_values)), None)
+
+        return df
+
+
+#per row version of RecordTransformer, kept as reference for benchmarks/bc_transform.py
+
+def transform_record(row : dict,fields : dict):
+
+    #for each dictionary which represents a row on the api response, rename, mapping the api fields to the sql table fields.
+
+    column_map = {v['endpoint_field']: k for k, v in fields.items()}
+
+    #custom mapping dictionaries, for certain columns as specified on db_schema.json, mapping empty values to None
+    # which is compatible with SQL NULL value
+
+    str_null_map = {'' : None,' ' : None}
+
+    int_null_map = {0 : None}
+
+    date_null_map = { '0001-01-01' : None}
+
+    row = {column_map.get(k, k): v for k, v in row.items()}
+
+    #custom logic that iterates over dictionary values to set None for empty values.
+
+    for f, attr in fields.items():
+
+        if attr['apply_null_format']:
+
+            match attr['type']:
+                
+                case 'str':
+
+                    row[f] = str_null_map.get(row[f], row[f])
+
+                case 'int':
+
+                    row[f] = int_null_map.get(row[f], row[f])
+
+                case 'date':
+
+                    row[f] = date_null_map.get(row[f],row[f])
+
+    return row
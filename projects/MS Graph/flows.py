@@ -2,13 +2,13 @@ import sys
 import os 
 import dotenv 
 
-project_dir = os.abspath(os.join(os.getcwd(), './'))
+project_dir = os.path.abspath(os.path.join(os.getcwd(), './'))
 sys.path.insert(0, project_dir)
 
 from src.sql_engine import SQLServerEngine
+from src.checkpoint_store import CheckpointStore
 from prefect import flow
 from tasks import retrieve_event_form_responses
-from utils.shared_tasks import update_table
 
 from azure.identity import ClientSecretCredential
 from msgraph import GraphServiceClient
@@ -31,10 +31,9 @@ def update_events_table(tenant_id,client_id,client_secret,server,database):
 
     Client = GraphServiceClient(credential,scopes)
     SQLSession = SQLServerEngine(server=server,database=database)
+    Checkpoints = CheckpointStore('msgraph',database,SQLSession=SQLSession)
 
-    df = retrieve_event_form_responses(GraphClient=Client,SQLSession=SQLSession,table='Eventos',primary_key='itemId')
-
-    update_table(SQLSession=SQLSession,dfs=df,table='Eventos',primary_key='itemId')
+    retrieve_event_form_responses(GraphClient=Client,SQLSession=SQLSession,Checkpoints=Checkpoints,table='Eventos',primary_key='itemId')
 
 if __name__ == '__main__':
     
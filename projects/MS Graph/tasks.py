@@ -8,14 +8,15 @@ sys.path.insert(0, project_dir)
 import asyncio
 from prefect import task
 from pandas import DataFrame
-from utils.utilities import set_null_values
-from numpy import nan
+from utils.utilities import normalize_null_values
 
 from src.sql_engine import SQLServerEngine
+from src.checkpoint_store import CheckpointStore
 from msgraph import GraphServiceClient
 
-from msgraph.generated.sites.item.lists.item.list_item_request_builder import ListItemRequestBuilder
+from msgraph.generated.sites.item.lists.item.items.delta.delta_request_builder import DeltaRequestBuilder
 from kiota_abstractions.base_request_configuration import RequestConfiguration
+from kiota_abstractions.api_error import APIError
 
 
 #credential = ClientSecretCredential(
@@ -27,84 +28,150 @@ from kiota_abstractions.base_request_configuration import RequestConfiguration
 #Client = GraphServiceClient(credential,scopes)
 
 
-async def get_list_items(GraphClient,site_id,list_id):
+#columnas de la tabla de eventos y el campo de la lista de SharePoint del que se obtienen
 
-    params = ListItemRequestBuilder.ListItemRequestBuilderGetQueryParameters(
+EVENT_FIELDS = {
 
-    expand = ["fields"]
+    'responseId' : 'ID_x002d_form',
+    'email' : 'Email',
+    'planCorrespondiente' : 'PlanCorrespondienteATuReporte',
+    'aQueRegionPerteneces' : 'AQueRegionPerteneces',
+    'estadoEvento' : 'EstadoDondeRealizasteEvento',
+    'fechaEvento' : 'FechaDelEvento',
+    'tipoEvento' : 'TipoEvento',
+    'nombreEvento' : 'NombreEvento',
+    'nivelEducativo' : 'SeleccionaNivelEducativo',
+    'personaVoluntaria' : 'PersonaVoluntariaQueAcompa_x00f1',
+    'personasImpactadas' : 'PersonasImpactadas',
+    'condonesRepartidos' : 'CondonesRepartidos',
+    'evidencia' : 'Evidencias',
+    'comentarios' : 'ComentariosEvento',
+    'materialesRepartidos' : 'MaterialesRepartidos',
+    'nombreTaller' : 'NombreDelTaller',
+    'comunidadVisitada' : 'NombreComunidadVisitada',
+    'createdAt' : 'Created'
+}
 
-    )   
+#codigos de error con los que Graph rechaza un delta_link expirado o invalido (410 Gone); hay que sincronizar desde cero
+
+RESYNC_ERROR_CODES = {'resyncRequired','syncStateNotFound','syncStateInvalid'}
+
+
+async def get_list_items_delta(GraphClient,site_id,list_id,fields,delta_link=None):
+
+    #consulta delta de los elementos de la lista: sin delta_link devuelve todos los elementos, con el delta_link de la
+    #ejecucion anterior solo los creados, modificados o eliminados desde entonces. Devuelve los elementos y el nuevo delta_link
+
+    params = DeltaRequestBuilder.DeltaRequestBuilderGetQueryParameters(
+
+    expand = [f'fields($select={",".join(fields)})']
+
+    )
 
     request_config = RequestConfiguration(
         query_parameters=params
     )
 
-    list_items = await GraphClient.sites.by_site_id(f'{site_id}').lists.by_list_id(f'{list_id}').items.get(request_configuration=request_config)
+    delta = GraphClient.sites.by_site_id(f'{site_id}').lists.by_list_id(f'{list_id}').items.delta
 
-    if list_items:
+    if delta_link:
 
-        data = list_items.value
-    
-    while list_items is not None and list_items.odata_next_link is not None: 
+        response = await delta.with_url(delta_link).get()
+
+    else:
+
+        response = await delta.get(request_configuration=request_config)
+
+    data = []
+
+    while response is not None:
+
+        data.extend(response.value or [])
+
+        if response.odata_next_link is None:
+
+            break
+
+        response = await delta.with_url(response.odata_next_link).get()
+
+    return data, response.odata_delta_link if response is not None else delta_link
 
-        list_items = await GraphClient.sites.by_site_id(f'{site_id}').lists.by_list_id(f'{list_id}').items.with_url(list_items.odata_next_link).get(request_configuration=request_config)
-    
-        data.extend(list_items.value)
-    
-    return data
+
+def requires_resync(error):
+
+    #True cuando Graph responde que el delta_link ya no es valido
+
+    code = getattr(getattr(error,'error',None),'code',None)
+
+    return error.response_status_code == 410 or code in RESYNC_ERROR_CODES
 
 
 @task(name='descarga respuestas eventos',log_prints=True)
-def retrieve_event_form_responses(GraphClient : GraphServiceClient,SQLSession : SQLServerEngine, table, primary_key):
+def retrieve_event_form_responses(GraphClient : GraphServiceClient,SQLSession : SQLServerEngine,Checkpoints : CheckpointStore, table, primary_key):
     
     site_id = '61085889-2859-43b4-9e56-5edc109aa0ac,41bc9dfa-8920-4971-bffc-7ec6b41dacfb'
     list_id = '74913d76-843e-488b-9f5a-960fc6dcc986'
 
-    data = asyncio.run(
-        get_list_items(GraphClient,site_id,list_id)
-        )
+    #el delta_link de la ultima ejecucion se guarda en el registro de checkpoints, solo se transfieren los elementos con cambios
+
+    delta_link = Checkpoints.get(list_id)
+
+    try:
+
+        data, delta_link = asyncio.run(
+            get_list_items_delta(GraphClient,site_id,list_id,list(EVENT_FIELDS.values()),delta_link)
+            )
+
+    except APIError as e:
+
+        if not delta_link or not requires_resync(e):
+
+            raise
+
+        #el delta_link expiro o dejo de ser valido: se descarta el checkpoint y se hace una sincronizacion completa,
+        #los elementos sin cambios se omiten en el upsert
+
+        print(f'El delta_link de la lista {list_id} ya no es valido, se sincroniza la lista completa: {e}')
+
+        Checkpoints.set(list_id,None)
+
+        data, delta_link = asyncio.run(
+            get_list_items_delta(GraphClient,site_id,list_id,list(EVENT_FIELDS.values()))
+            )
 
     main_list = []
     
     
     for ListItem in data:
 
+        #los elementos eliminados de la lista se conservan en la tabla
+
+        if ListItem.deleted is not None or ListItem.fields is None:
+
+            continue
         
         fields = ListItem.fields.additional_data
         
-        items_d = {
-
-            'itemId' : ListItem.id,
-            'responseId' : fields.get('ID_x002d_form'),
-            'email' : fields.get('Email'),
-            'planCorrespondiente' : fields.get('PlanCorrespondienteATuReporte'),
-            'aQueRegionPerteneces' : fields.get('AQueRegionPerteneces'),
-            'estadoEvento' : fields.get('EstadoDondeRealizasteEvento'),
-            'fechaEvento' : fields.get('FechaDelEvento'),
-            'tipoEvento' : fields.get('TipoEvento'),
-            'nombreEvento' : fields.get('NombreEvento'),
-            'nivelEducativo' : fields.get('SeleccionaNivelEducativo'),
-            'personaVoluntaria' : fields.get('PersonaVoluntariaQueAcompa_x00f1'),
-            'personasImpactadas' : fields.get('PersonasImpactadas'),
-            'condonesRepartidos' : fields.get('CondonesRepartidos'),
-            'evidencia' : fields.get('Evidencias'),
-            'comentarios' : fields.get('ComentariosEvento'),
-            'materialesRepartidos' : fields.get('MaterialesRepartidos'),
-            'nombreTaller' : fields.get('NombreDelTaller'),
-            'comunidadVisitada' : fields.get('NombreComunidadVisitada'),
-            'createdAt' : fields.get('Created')         
-            }
+        items_d = {'itemId' : ListItem.id}
+
+        items_d.update({column : fields.get(field) for column, field in EVENT_FIELDS.items()})
         
         main_list.append(items_d)
 
+    result = {'insert' : 0, 'update' : 0}
+
+    if main_list:
     
-    ids = set(SQLSession.select_values(table,columns=[primary_key]))
+        df = normalize_null_values(DataFrame(main_list))
+
+        result = SQLSession.upsert_from_df(table,df,primary_key,skip_unchanged=True)
+
+    else:
 
-    df = DataFrame(main_list).map(set_null_values).replace({nan:None})
+        print(f'No se encontraron registros nuevos o modificados para actualizar en la tabla {table}')
 
-    df_to_insert = df[~df[primary_key].isin(ids)]
+    #el delta_link solo avanza despues de escribir los cambios
 
-    return {
+    Checkpoints.set(list_id,delta_link)
 
-            'insert' : df_to_insert
-        }
+    return result
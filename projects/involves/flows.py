@@ -1,8 +1,10 @@
 from tasks import *
 from prefect import flow
+from datetime import date
 from utils.webhooks import success_hook,failure_hook
 from src.involves_api_client import InvolvesAPIClient
 from src.sql_engine import SQLServerEngine
+from src.checkpoint_store import CheckpointStore
 
 @flow(name='integracion_SQL_involves_clinical',
       log_prints=True,
@@ -14,6 +16,7 @@ def update_involves_clinical_db(environment,domain,username,password,engine_type
 
     Client = InvolvesAPIClient(environment,domain,username,password)
     SQLSession = SQLServerEngine(engine_type,server,database)
+    Checkpoints = CheckpointStore('involves',environment,SQLSession=SQLSession)
 
     pos_fields = [
 
@@ -58,23 +61,23 @@ def update_involves_clinical_db(environment,domain,username,password,engine_type
 
 
 
-    pos = get_pointofsale_data.submit(Client=Client,SQLSession=SQLSession,fields=pos_fields,table='PointOfSale',primary_key='id')
+    pos = get_pointofsale_data.submit(Client=Client,SQLSession=SQLSession,Checkpoints=Checkpoints,fields=pos_fields,table='PointOfSale',primary_key='id')
 
     employees = get_employee_data.submit(Client=Client,SQLSession=SQLSession,fields=employee_fields,table='Employee',primary_key='id')
 
-    visits = get_visit_data.submit(SQLSession,username,password,environment,domain,fields=visit_fields,table='Visit')  
+    visits = get_visit_data.submit(SQLSession,Checkpoints,username,password,environment,domain,fields=visit_fields,table='Visit',primary_key=['visit_date','customer_id'])  
 
-    channels = get_channel_data.submit(Client=Client,SQLSession=SQLSession,table='Channel',primary_key='id')
+    channels = get_channel_data.submit(Client=Client)
 
-    chains = get_chain_data.submit(Client=Client,SQLSession=SQLSession,fields=['id','name'],table='Chain',primary_key='id')
+    chains = get_chain_data.submit(Client=Client,fields=['id','name'])
 
-    regions = get_region_data.submit(Client=Client,SQLSession=SQLSession,fields=['id','name'],table='Region',primary_key='id')
+    regions = get_region_data.submit(Client=Client,fields=['id','name'])
 
 
     update_table.map(SQLSession,
-                     dfs=[pos,employees,channels,chains,regions,visits],
-                     table=['PointOfSale','Employee','Channel','Chain','Region','Visit'],
-                     primary_key=['id','id','id','id','id',['visit_date','customer_id']]
+                     df=[channels,chains,regions],
+                     table=['Channel','Chain','Region'],
+                     primary_key=['id','id','id']
                      )
 
 
@@ -82,19 +85,10 @@ def update_involves_clinical_db(environment,domain,username,password,engine_type
       log_prints=True,
       )
 
-def update_surveys(Client: InvolvesAPIClient,SQLSession: SQLServerEngine, formIds: list):
+def update_surveys(Client: InvolvesAPIClient,SQLSession: SQLServerEngine,Checkpoints: CheckpointStore, formIds: list):
 
 
-    survey, survey_answers = get_survey_data(Client,SQLSession,'Survey','id',formIds=formIds)
-
-    tables_to_insert = {
-
-        'Survey': survey,
-
-        'SurveyAnswer': survey_answers
-    }
-
-    insert_records_into_table(SQLSession,tables_to_insert)
+    get_survey_data(Client,SQLSession,Checkpoints,'Survey','id',formIds=formIds,answers_table='SurveyAnswer')
 
 
 @flow(name='integracion_SQL_involves_dkt',
@@ -107,6 +101,7 @@ def update_involves_dkt_db(environment,domain,username,password,engine_type,data
 
     Client = InvolvesAPIClient(environment,domain,username,password)
     SQLSession = SQLServerEngine(engine_type,server,database)
+    Checkpoints = CheckpointStore('involves',environment,SQLSession=SQLSession)
 
     pos_fields = [
           
@@ -164,38 +159,56 @@ def update_involves_dkt_db(environment,domain,username,password,engine_type,data
         'absenceNote'
     ]
 
-    pos = get_pointofsale_data.submit(Client=Client,SQLSession=SQLSession,fields=pos_fields,table='PointOfSale',primary_key='id')
+    pos = get_pointofsale_data.submit(Client=Client,SQLSession=SQLSession,Checkpoints=Checkpoints,fields=pos_fields,table='PointOfSale',primary_key='id')
 
     employees = get_employee_data.submit(Client=Client,SQLSession=SQLSession,fields=employee_fields,table='Employee',primary_key='id')
 
-    visits = get_visit_data.submit(SQLSession,username,password,environment,domain,fields=visit_fields,table='Visit')  
+    visits = get_visit_data.submit(SQLSession,Checkpoints,username,password,environment,domain,fields=visit_fields,table='Visit',primary_key=['visit_date','customer_id'])  
 
-    channels = get_channel_data.submit(Client=Client,SQLSession=SQLSession,table='Channel',primary_key='id')
+    channels = get_channel_data.submit(Client=Client)
 
-    chains = get_chain_data.submit(Client=Client,SQLSession=SQLSession,fields=['id','name'],table='Chain',primary_key='id')
+    chains = get_chain_data.submit(Client=Client,fields=['id','name'])
 
-    regions = get_region_data.submit(Client=Client,SQLSession=SQLSession,fields=['id','name','macroregional_id'],table='Region',primary_key='id')
+    regions = get_region_data.submit(Client=Client,fields=['id','name','macroregional_id'])
 
     macroregion_ids = set(SQLSession.select_values(table='Region',columns=['macroregional_id']))
 
-    macroregions = get_macroregional_data.submit(Client=Client,SQLSession=SQLSession,ids=macroregion_ids,table='MacroRegional',primary_key='id')
+    macroregions = get_macroregional_data.submit(Client=Client,ids=macroregion_ids)
 
-    absences = get_employee_absence_data.submit(Client=Client,SQLSession=SQLSession,table='EmployeeAbsence',fields=absence_fields,primary_key='id')
+    absences = get_employee_absence_data.submit(Client=Client,fields=absence_fields)
 
-    forms = get_form_data.submit(Client=Client,SQLSession=SQLSession,table='Form',primary_key='id')
+    forms = get_form_data.submit(Client=Client)
 
     form_ids = set(SQLSession.select_values(table='Form',columns=['id']))
 
-    form_fields = get_form_fields_data.submit(Client=Client,SQLSession=SQLSession,ids=form_ids,table='FormField',primary_key='id')
+    form_fields = get_form_fields_data.submit(Client=Client,ids=form_ids)
 
 
     update_table.map(SQLSession,
-                dfs=[pos,employees,channels,chains,regions,visits,macroregions,absences,forms,form_fields],
-                table=['PointOfSale','Employee','Channel','Chain','Region','Visit','MacroRegional','EmployeeAbsence','Form','FormField'],
-                primary_key=['id','id','id','id','id',['visit_date','customer_id'],'id','id','id','id']
+                df=[channels,chains,regions,macroregions,absences,forms,form_fields],
+                table=['Channel','Chain','Region','MacroRegional','EmployeeAbsence','Form','FormField'],
+                primary_key=['id','id','id','id','id','id','id']
                 )
     
-    update_surveys(Client,SQLSession,formIds=[16,111])
+    update_surveys(Client,SQLSession,Checkpoints,formIds=[16,111])
+
+ 
+@flow(name='recuperacion_visitas_involves',
+      log_prints=True,
+      on_completion=[success_hook],
+      on_failure=[failure_hook]
+      )
+
+def backfill_involves_visits(environment,domain,username,password,engine_type,database,server,start_date: date,end_date: date,
+                             fields: list,chunk_days=1,max_workers=3):
+
+    #recupera las visitas de un rango de fechas, p. ej. despues de varios dias sin ejecuciones; fields son las columnas
+    #de la tabla Visit del ambiente, en el mismo orden que visit_fields en update_involves_clinical_db / update_involves_dkt_db
+
+    SQLSession = SQLServerEngine(engine_type,server,database)
+
+    backfill_visit_data(SQLSession,username,password,environment,domain,fields=fields,table='Visit',primary_key=['visit_date','customer_id'],
+                        start_date=start_date,end_date=end_date,chunk_days=chunk_days,max_workers=max_workers)
 
  
 if __name__ == '__main__':
@@ -5,258 +5,321 @@ project_dir = abspath(join(getcwd(), './'))
 sys.path.insert(0, project_dir)
 
 from pandas import DataFrame
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from numpy import nan
 from prefect import task
-from utils.utilities import download_visits, set_null_values
+from utils.utilities import download_visits, normalize_null_values
 from utils.retry_handlers import visit_bot_retry_fn
 from prefect import task
 from prefect.artifacts import create_markdown_artifact
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
 from src.involves_api_client import InvolvesAPIClient
+from src.involves_web_client import InvolvesWebClient
 from src.sql_engine import SQLServerEngine
+from src.checkpoint_store import CheckpointStore
 
 @task(name='actualizar tabla SQL',log_prints=True)
-def update_table(SQLSession,dfs,table,primary_key):
+def update_table(SQLSession,df,table,primary_key):
 
-    if 'insert' in dfs:
+    if not df.empty:
 
-        df = dfs['insert']
+        result = SQLSession.upsert_from_df(table,df,primary_key,skip_unchanged=True)
 
-        table_data = {
-             
-             table : df
-        }
+        create_markdown_artifact(markdown=df.to_markdown(index=False),description=f"{result['insert']} registros nuevos, {result['update']} registros actualizados")
 
-        if not df.empty:
+    else:
+        print(f'No se encontraron registros nuevos o modificados para actualizar en la tabla {table}')
 
-            SQLSession.bulk_insert_from_df(table_data)
-            create_markdown_artifact(markdown=df.to_markdown(index=False),description='registros nuevos')
 
-        else:
-            print(f'No se encontraron registros nuevos para añadir a la tabla {table}')
-        
-        if 'update' in dfs:
+@task(name='descarga puntos de venta',log_prints=True,retries=2)
+def get_pointofsale_data(Client,SQLSession,Checkpoints,fields,table,primary_key):
 
-            df = dfs['update']
-     
-            if not df.empty:
-               
-               SQLSession.update_records_from_df(table,df,primary_key)
-               create_markdown_artifact(markdown=df.to_markdown(index=False),description='Registros actualizados')
-
-            else:
-               print(f'No se encontraron registros modificados para actualizar en la tabla {table}')
-
-        if 'delete' in dfs:
-           
-           df = dfs['delete']
-           
-           if not df.empty:
-                #---
-                create_markdown_artifact(markdown=df.to_markdown(index=False),description='Registros eliminados')
-               
-           else:
-               print(f'No se encontraron registros eliminados en la tabla {table}')
-
-
-@task(name='insertar registros SQL',log_prints=True)
-def insert_records_into_table(SQLSession:SQLServerEngine,tables:dict):
-        
+    timestamp = int(datetime.now().timestamp()*1000)
 
-        SQLSession.bulk_insert_from_df(tables)
+    #la marca de la ultima actualizacion se lee del registro de checkpoints, y solo la primera vez de la tabla destino
 
-        for table_name, df in tables.items():
+    last_update_timestamp = Checkpoints.get(table)
 
-            if not df.empty:
-             
-                create_markdown_artifact(markdown=df.to_markdown(index=False),description=f'registros nuevos tabla {table_name}')
+    if last_update_timestamp is None:
 
+        last_update_timestamp = SQLSession.get_last_update(table,time_column='updated_at')
 
+    inserted, updated = 0, 0
 
-@task(name='descarga puntos de venta',log_prints=True,retries=2)
-def get_pointofsale_data(Client,SQLSession,fields,table,primary_key):
+    for rows in Client.iter_pointsofsale(select=fields,updatedAtMillis=last_update_timestamp):
 
-    timestamp = int(datetime.now().timestamp()*1000)
+        if rows:
 
-    last_update_timestamp = SQLSession.get_last_update(table,time_column='updated_at')
+            df = DataFrame(rows).assign(updated_at=timestamp)
 
-    rows = Client.get_pointsofsale(select=fields,updatedAtMillis=last_update_timestamp)
+            df = normalize_null_values(df)
 
-    if rows:
-            
-        df = DataFrame(rows).assign(updated_at=timestamp)
-        
-        df = df.map(set_null_values).replace({nan:None})
+            result = SQLSession.upsert_from_df(table,df,primary_key,skip_unchanged=True,ignore_columns=['updated_at'])
 
-        ids = set(SQLSession.select_values(table,columns=[primary_key]))
+            inserted += result['insert']
+            updated += result['update']
 
-        df_to_insert = df[~df[primary_key].isin(ids)]
+    #el checkpoint solo avanza cuando todos los lotes se escribieron, si la descarga se interrumpe
+    #la siguiente ejecucion vuelve a solicitar todos los registros pendientes
 
-        df_to_update = df[df[primary_key].isin(ids)]
+    Checkpoints.set(table,timestamp)
 
-    
-    else:
+    if inserted or updated:
 
-        df_to_insert = DataFrame({})
-        df_to_update = DataFrame({})
+        create_markdown_artifact(markdown=f'{inserted} registros nuevos, {updated} registros actualizados',description=f'actualizacion tabla {table}')
 
-        print('No se añadieron o modificaron registros desde la última actualización')
+    else:
 
+        print('No se añadieron o modificaron registros desde la última actualización')
 
     return {
-         
-          'insert':df_to_insert,
-          'update':df_to_update
-     } 
+
+        'insert' : inserted,
+        'update' : updated
+    }
 
 
 
 @task(name='descarga empleados',log_prints=True,retries=2)
 def get_employee_data(Client,SQLSession,fields,table,primary_key):
 
-     timestamp = int(datetime.now().timestamp()*1000)
+    timestamp = int(datetime.now().timestamp()*1000)
 
+    inserted, updated = 0, 0
 
-     rows = Client.get_employees(select=fields)
+    for rows in Client.iter_employees(select=fields):
 
-     if rows:
-            
-            df = DataFrame(rows).assign(updated_at=timestamp).map(set_null_values).replace({nan:None})
+        if rows:
 
-            ids = set(SQLSession.select_values(table,columns=[primary_key]))
+            df = normalize_null_values(DataFrame(rows).assign(updated_at=timestamp))
 
-            df_to_insert = df[~df[primary_key].isin(ids)]
-      
-            df_to_update = df[df[primary_key].isin(ids)]
-            
-     else:
+            result = SQLSession.upsert_from_df(table,df,primary_key,skip_unchanged=True,ignore_columns=['updated_at'])
 
-            df_to_insert = DataFrame({})
-            df_to_update = DataFrame({})
+            inserted += result['insert']
+            updated += result['update']
 
-            print('No se añadieron o modificaron registros desde la última actualización')
+    if inserted or updated:
 
+        create_markdown_artifact(markdown=f'{inserted} registros nuevos, {updated} registros actualizados',description=f'actualizacion tabla {table}')
 
-     return {
-          
-          'insert': df_to_insert,
-          'update':df_to_update
-          }
+    else:
+
+        print('No se añadieron o modificaron registros desde la última actualización')
+
+    return {
+
+        'insert' : inserted,
+        'update' : updated
+    }
 
      
 @task(name='descarga visitas',log_prints=True,retries=3,retry_condition_fn=visit_bot_retry_fn)
-def get_visit_data(SQLSession,username,password,environment,domain,fields,table):
+def get_visit_data(SQLSession,Checkpoints,username,password,environment,domain,fields,table,primary_key,WebClient:InvolvesWebClient=None):
 
-     date = SQLSession.get_last_visit_date(table,column='visit_date')
+     #el checkpoint guarda las dos fechas de visita mas recientes ya escritas; la descarga inicia en la penultima,
+     #igual que la consulta MAX anidada de get_last_visit_date que solo se usa la primera vez
 
-     df = download_visits(username,password,date,environment,domain)
+     last_dates = Checkpoints.get(table)
 
-     df.columns = fields
+     if last_dates:
+
+          date = datetime.fromisoformat(last_dates[-1])
+
+     else:
+
+          date = SQLSession.get_last_visit_date(table,column='visit_date')
+
+     #con WebClient el informe se descarga por HTTP, sin abrir el navegador
+
+     if WebClient is not None:
+
+          df = WebClient.download_visits(date)
+
+     else:
+
+          df = download_visits(username,password,date,environment,domain)
+
+     df = clean_visits(df,fields,primary_key)
+
+     if not df.empty:
+
+          result = SQLSession.upsert_from_df(table,df,primary_key,skip_unchanged=True)
+
+          create_markdown_artifact(markdown=df.to_markdown(index=False),description=f"{result['insert']} registros nuevos, {result['update']} registros actualizados")
+
+          dates = {d.isoformat() for d in df['visit_date']} | set(last_dates or [])
+
+          Checkpoints.set(table,sorted(dates,reverse=True)[:2])
+
+     else:
+
+          print(f'No se encontraron registros nuevos o modificados para actualizar en la tabla {table}')
+
+     return df
+
+
+@task(name='recuperacion visitas',log_prints=True)
+def backfill_visit_data(SQLSession,username,password,environment,domain,fields,table,primary_key,start_date,end_date,
+                        chunk_days=1,max_workers=3,WebClient:InvolvesWebClient=None):
+
+     #divide el rango [start_date, end_date] en bloques de chunk_days dias que se escriben de forma independiente;
+     #un bloque con error no detiene a los demas. Por HTTP cada bloque se descarga por separado y en paralelo (hasta max_workers
+     #a la vez) enviando su fecha final; con el navegador el panel solo filtra por fecha inicial, por lo que el informe
+     #se descarga una sola vez desde start_date y se divide en bloques localmente
+
+     chunks = []
+
+     chunk_start = start_date
+
+     while chunk_start <= end_date:
+
+          chunk_end = min(chunk_start + timedelta(days=chunk_days - 1),end_date)
+
+          chunks.append((chunk_start,chunk_end))
+
+          chunk_start = chunk_end + timedelta(days=1)
+
+     def in_chunk(df,chunk):
+
+          return df[df['visit_date'].map(lambda d: chunk[0] <= d <= chunk[1])]
+
+     if WebClient is not None:
+
+          #la sesion se inicia una vez antes de abrir el pool, los bloques comparten el cliente
+
+          WebClient.ensure_session()
+
+          def download_chunk(chunk):
+
+               return in_chunk(clean_visits(WebClient.download_visits(chunk[0],chunk[1]),fields,primary_key),chunk)
+
+     else:
+
+          visits = clean_visits(download_visits(username,password,start_date,environment,domain),fields,primary_key)
+
+          def download_chunk(chunk):
+
+               return in_chunk(visits,chunk)
+
+          max_workers = 1
+
+     inserted, updated, failed = 0, 0, []
+
+     with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+          futures = {executor.submit(download_chunk,chunk) : chunk for chunk in chunks}
+
+          for future in as_completed(futures):
+
+               chunk = futures[future]
+
+               try:
+
+                    df = future.result()
+
+                    if not df.empty:
 
-     ids = set(SQLSession.select_values(table,columns=['visit_date','customer_id']))
+                         result = SQLSession.upsert_from_df(table,df,primary_key,skip_unchanged=True)
 
-     df_to_insert = df[~df.apply(lambda row: (row['visit_date'],row['customer_id']) in ids, axis=1)].replace({nan:None})
-     df_to_update = df[df.apply(lambda row: (row['visit_date'],row['customer_id']) in ids, axis=1)].replace({nan:None})
+                         inserted += result['insert']
+                         updated += result['update']
+
+                    print(f'Bloque {chunk[0]} - {chunk[1]}: {len(df)} visitas')
+
+               except Exception as e:
+
+                    print(f'Error al recuperar las visitas del bloque {chunk[0]} - {chunk[1]}: {e}')
+
+                    failed.append(chunk)
+
+     create_markdown_artifact(markdown=f'{inserted} registros nuevos, {updated} registros actualizados, {len(failed)} bloques con error',
+                              description=f'recuperacion tabla {table} del {start_date} al {end_date}')
+
+     if failed:
+
+          raise RuntimeError(f'No se recuperaron las visitas de los bloques: {", ".join(f"{a} - {b}" for a, b in sorted(failed))}')
 
      return {
 
-          'insert' : df_to_insert,
-          'update' : df_to_update
+          'insert' : inserted,
+          'update' : updated
      }
 
 
+def clean_visits(df,fields,primary_key):
+
+     df.columns = fields
+
+     #las filas con la llave compuesta incompleta no pueden compararse contra la tabla destino
+
+     incomplete = df[primary_key].isna().any(axis=1)
+
+     if incomplete.any():
+
+          print(f'Se descartaron {incomplete.sum()} visitas sin valor en {", ".join(primary_key)}')
+
+     return df[~incomplete].drop_duplicates(subset=primary_key,keep='last').replace({nan:None})
+
+
 @task(name='descarga canales PDV',log_prints=True)
-def get_channel_data(Client,SQLSession,table,primary_key):
+def get_channel_data(Client):
      
      rows = Client.get_channels()
 
      if rows:
             
-            df = DataFrame(rows).map(set_null_values).replace({nan:None})
-
-            ids = set(SQLSession.select_values(table,columns=[primary_key]))
-
-            df_to_insert = df[~df[primary_key].isin(ids)]
-
-            df_to_update = df[df[primary_key].isin(ids)]
+            df = normalize_null_values(DataFrame(rows))
             
      else:
 
-            df_to_insert = DataFrame({})
-            df_to_update = DataFrame({})
+            df = DataFrame({})
 
             print('No se añadieron o modificaron registros desde la última actualización')
 
 
-     return {
-          
-          'insert': df_to_insert,
-          'update':df_to_update
-          }
+     return df
 
 @task(name='descarga cadenas PDV',log_prints=True)
-def get_chain_data(Client,SQLSession,table,fields,primary_key):
+def get_chain_data(Client,fields):
       
       rows = Client.get_chains(select=fields)
 
       if rows:
             
-            df = DataFrame(rows).map(set_null_values).replace({nan:None})
-
-            ids = set(SQLSession.select_values(table,columns=[primary_key]))
-
-            df_to_insert = df[~df[primary_key].isin(ids)]
-
-            df_to_update = df[df[primary_key].isin(ids)]
+            df = normalize_null_values(DataFrame(rows))
             
       else:
 
-            df_to_insert = DataFrame({})
-            df_to_update = DataFrame({})
+            df = DataFrame({})
 
             print('No se añadieron o modificaron registros desde la última actualización')
 
 
-      return {
-          
-          'insert': df_to_insert,
-          'update':df_to_update
-          }
+      return df
       
             
 @task(name='descarga regiones',log_prints=True)
-def get_region_data(Client,SQLSession,table,fields,primary_key):
+def get_region_data(Client,fields):
             
       rows = Client.get_regions(select=fields)
 
       if rows:
             
-            df = DataFrame(rows).map(set_null_values).replace({nan:None})
-
-            ids = set(SQLSession.select_values(table,columns=[primary_key]))
-
-            df_to_insert = df[~df[primary_key].isin(ids)]
-
-            df_to_update = df[df[primary_key].isin(ids)]
+            df = normalize_null_values(DataFrame(rows))
             
       else:
 
-            df_to_insert = DataFrame({})
-            df_to_update = DataFrame({})
+            df = DataFrame({})
 
             print('No se añadieron o modificaron registros desde la última actualización')
 
 
-      return {
-          
-          'insert': df_to_insert,
-          'update':df_to_update
-          }
+      return df
 
 @task(name='descarga macroregionales',log_prints=True)
-def get_macroregional_data(Client,SQLSession,ids,table,primary_key):
+def get_macroregional_data(Client,ids):
      
      
     rows = list()
@@ -272,91 +335,56 @@ def get_macroregional_data(Client,SQLSession,ids,table,primary_key):
 
     if rows:
             
-            df = DataFrame(rows).map(set_null_values).replace({nan:None})
-
-            ids = set(SQLSession.select_values(table,columns=[primary_key]))
-
-            df_to_insert = df[~df[primary_key].isin(ids)]
-
-            df_to_update = df[df[primary_key].isin(ids)]
+            df = normalize_null_values(DataFrame(rows))
             
     else:
 
-            df_to_insert = DataFrame({})
-            df_to_update = DataFrame({})
+            df = DataFrame({})
 
             print('No se añadieron o modificaron registros desde la última actualización')
 
 
-    return {
-          
-          'insert': df_to_insert,
-          'update':df_to_update
-          }
+    return df
 
 
 @task(name='descarga ausencias empleados',log_prints=True)
-def get_employee_absence_data(Client,SQLSession,table,fields,primary_key):
+def get_employee_absence_data(Client,fields):
      
     rows = Client.get_employee_absences(select=fields)
 
     if rows:
             
-        df = DataFrame(rows).map(set_null_values).replace({nan:None})
-
-        ids = set(SQLSession.select_values(table,columns=[primary_key]))
-
-        df_to_insert = df[~df[primary_key].isin(ids)]
-
-        df_to_update = df[df[primary_key].isin(ids)]
+        df = normalize_null_values(DataFrame(rows))
             
     else:
 
-        df_to_insert = DataFrame({})
-        df_to_update = DataFrame({})
+        df = DataFrame({})
 
         print('No se añadieron o modificaron registros desde la última actualización')
 
 
-    return {
-          
-          'insert': df_to_insert,
-          'update': df_to_update
-
-          }
+    return df
 
 @task(name='descarga formularios',log_prints=True)       
-def get_form_data(Client,SQLSession,table,primary_key):
+def get_form_data(Client):
          
     rows = Client.get_activated_forms()
 
     if rows:
             
-        df = DataFrame(rows).map(set_null_values).replace({nan:None})
-
-        ids = set(SQLSession.select_values(table,columns=[primary_key]))
-
-        df_to_insert = df[~df[primary_key].isin(ids)]
-
-        df_to_update = df[df[primary_key].isin(ids)]
+        df = normalize_null_values(DataFrame(rows))
             
     else:
 
-        df_to_insert = DataFrame({})
-        df_to_update = DataFrame({})
+        df = DataFrame({})
 
         print('No se añadieron o modificaron registros desde la última actualización')
 
 
-    return {
-          
-          'insert': df_to_insert,
-          'update': df_to_update
-
-          }
+    return df
      
 @task(name='descarga campos formularios',log_prints=True)
-def get_form_fields_data(Client,SQLSession,ids,table,primary_key):
+def get_form_fields_data(Client,ids):
      
     rows = list()
 
@@ -378,36 +406,29 @@ def get_form_fields_data(Client,SQLSession,ids,table,primary_key):
 
     if rows:
             
-            df = DataFrame(rows).map(set_null_values).replace({nan:None})
-
-            ids = set(SQLSession.select_values(table,columns=[primary_key]))
-
-            df_to_insert = df[~df[primary_key].isin(ids)]
-
-            df_to_update = df[df[primary_key].isin(ids)]
+            df = normalize_null_values(DataFrame(rows))
 
             
     else:
 
-            df_to_insert = DataFrame({})
-            df_to_update = DataFrame({})
+            df = DataFrame({})
 
             print('No se añadieron o modificaron registros desde la última actualización')
 
 
-    return {
-          
-          'insert': df_to_insert,
-          'update': df_to_update
-          }
+    return df
 
 @task(name='descarga encuestas',log_prints=True)
-def get_survey_data(Client:InvolvesAPIClient,SQLSession:SQLServerEngine,table,primary_key,formIds:list):
+def get_survey_data(Client:InvolvesAPIClient,SQLSession:SQLServerEngine,Checkpoints:CheckpointStore,table,primary_key,formIds:list,answers_table='SurveyAnswer',batch_size=500):
 
+    #limite inferior fijo de ids por formulario, guardado en el registro de checkpoints y que no avanza: los ids se asignan
+    #al crear la encuesta, de modo que una encuesta respondida despues de otra con id mayor seguiria pendiente. Las encuestas
+    #faltantes sobre el limite se obtienen comparando contra la tabla con diff_from_df.
+    #los valores iniciales corresponden a los limites historicos del ambiente 1
 
     if Client.environment == 1:
          
-        limits = {
+        default_limits = {
               
               16 : 1804758,
               111: 1804637
@@ -415,7 +436,23 @@ def get_survey_data(Client:InvolvesAPIClient,SQLSession:SQLServerEngine,table,pr
     
     else:
          
-         limits = {}
+         default_limits = {}
+
+    limits = {}
+
+    for _ in formIds:
+
+        lower_limit = Checkpoints.get(f'{table}_{_}')
+
+        if lower_limit is None and _ in default_limits:
+
+            lower_limit = default_limits[_]
+
+            Checkpoints.set(f'{table}_{_}',lower_limit)
+
+        if lower_limit is not None:
+
+            limits[_] = lower_limit
 
         
     valid_ids = set()
@@ -434,18 +471,22 @@ def get_survey_data(Client:InvolvesAPIClient,SQLSession:SQLServerEngine,table,pr
 
              response_ids = {r['id'] for r in response}  
 
-        valid_ids.update(response_ids)  
+        valid_ids.update(response_ids)
 
-    existing_ids = set(SQLSession.select_values(table,columns=[primary_key]))
+    new_ids = SQLSession.diff_from_df(table,DataFrame({primary_key : sorted(valid_ids)}),primary_key,compare=False)['insert']
 
-    ids = valid_ids - existing_ids
+    ids = new_ids[primary_key].tolist()
 
     header = []
     detail = []
+    inserted = 0
 
-    for _ in ids:
-         
-         row = Client.get_survey_response_by_id(_,select=['form_id','id','responseDate','ownerId','pointOfSaleId','answers'])
+    #las respuestas se descargan en paralelo y se insertan por lotes conforme se completan,
+    #de modo que una falla a mitad de la ejecucion conserva los lotes ya insertados
+
+    responses = Client.iter_survey_responses(ids,select=['form_id','id','responseDate','ownerId','pointOfSaleId','answers'])
+
+    for _, row in zip(ids,responses):
 
          survey_header = row.copy()
 
@@ -467,27 +508,40 @@ def get_survey_data(Client:InvolvesAPIClient,SQLSession:SQLServerEngine,table,pr
 
               detail.append(survey_detail)
 
+         if len(header) >= batch_size:
+
+              insert_survey_batch(SQLSession,table,answers_table,header,detail)
+
+              inserted += len(header)
+
+              header, detail = [], []
+
     if header:
-         
-         header = DataFrame(header).map(set_null_values).replace({nan:None})
-         detail = DataFrame(detail).map(set_null_values).replace({nan:None})
 
+         insert_survey_batch(SQLSession,table,answers_table,header,detail)
+
+         inserted += len(header)
+
+    if inserted:
+
+         create_markdown_artifact(markdown=f'{inserted} encuestas nuevas',description=f'registros nuevos tablas {table}, {answers_table}')
 
     else:
-         
-         header = DataFrame({})
-         detail = DataFrame({})
 
          print('No se añadieron o modificaron registros desde la última actualización')
     
 
-    return header, detail
+    return inserted
 
-     
-    
-    
-          
 
-     
-     
-     
\ No newline at end of file
+def insert_survey_batch(SQLSession,table,answers_table,header,detail):
+
+    tables = {
+
+        table : normalize_null_values(DataFrame(header)),
+
+        answers_table : normalize_null_values(DataFrame(detail))
+    }
+
+    SQLSession.bulk_insert_from_df(tables)
+
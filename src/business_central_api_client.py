@@ -1,8 +1,24 @@
 import requests
 import urllib.parse
+import time
+from os import replace, fdopen, fchmod, open as os_open, O_WRONLY, O_CREAT, O_TRUNC
+from os.path import exists
+from math import ceil
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from msal import ConfidentialClientApplication
 import json
 
+
+#tokens and msal applications shared by every client of the process, keyed by authority, client id and scopes,
+#so new clients (e.g. one per flow run or per table) reuse a valid token instead of authenticating again.
+
+_token_cache = {}
+_auth_clients = {}
+_token_cache_lock = Lock()
+
+
 class BusinessCentralAPIClient(requests.Session):
     """
     A class  that inherits from requests.Session class for interacting with Dynamics 365 Business Central API.
@@ -26,6 +42,10 @@ class BusinessCentralAPIClient(requests.Session):
             Reference to Microsoft Documentation: https://learn.microsoft.com/en-us/dynamics365/business-central/application/base-application/table/microsoft.sales.customer.customer
         PRODUCT_TABLE_ENDPOINT (str) : name of the custom API page entity which exposes data from Item Table (ID 27)
             Reference to Microsoft Documentation: https://learn.microsoft.com/en-us/dynamics365/business-central/application/base-application/table/microsoft.inventory.item.item
+        max_concurrency (int) : maximum number of partitions fetched concurrently in partitioned requests.
+        token_cache_path (str) : path of a local JSON file used to share the access token across flow runs, written with 0600 permissions. (optional)
+        token_cache_block (str) : name of a Prefect Secret block used to share the access token across flow runs. (optional)
+        refresh_margin (int) : seconds before the token expiration at which a new token is requested.
     """
 
     CUSTOMER_TABLE_ENDPOINT = 'SQLCustomer'
@@ -37,7 +57,11 @@ class BusinessCentralAPIClient(requests.Session):
                  company,
                  client_id,
                  client_secret,
-                 scopes=['https://api.businesscentral.dynamics.com/.default']
+                 scopes=['https://api.businesscentral.dynamics.com/.default'],
+                 max_concurrency=4,
+                 token_cache_path=None,
+                 token_cache_block=None,
+                 refresh_margin=300
                  ):
         """
         Initializes the API Client with the necessary credentials and base URL.
@@ -48,6 +72,10 @@ class BusinessCentralAPIClient(requests.Session):
             company (str): Name of the company within the environment.
             client_id (str): The client ID of your registered Azure App.
             client_secret (str): The client secret of your registered Azure App.
+            max_concurrency (int): Maximum number of partitions fetched concurrently.
+            token_cache_path (str): Path of a JSON file to persist the access token across flow runs. (optional)
+            token_cache_block (str): Name of a Prefect Secret block to persist the access token across flow runs. (optional)
+            refresh_margin (int): Seconds before expiration at which the token is refreshed.
         """
         super().__init__()
 
@@ -57,56 +85,179 @@ class BusinessCentralAPIClient(requests.Session):
         self.client_id = client_id
         self.client_secret = client_secret
         self.scopes = scopes
+        self.max_concurrency = max_concurrency
         self.base_url = f"https://api.businesscentral.dynamics.com/v2.0/{self.tenant_id}/{self.environment}/ODataV4/Company('{self.company}')/"
         self.authority = f"https://login.microsoftonline.com/{self.tenant_id}"
+        self.token_cache_path = token_cache_path
+        self.token_cache_block = token_cache_block
+        self.refresh_margin = refresh_margin
         self.access_token = None
         self.token_type = None
-        self.get_oauth_token()
+        self.expires_at = 0
+        self.token_lock = Lock()
+        self.mount('https://',HTTPAdapter(pool_connections=1,pool_maxsize=self.max_concurrency))
         self.headers.update(
             {
-                'Authorization': f'{self.token_type} {self.access_token}',
                 'Accept': 'application/json',
                 'Content-Type': 'application/x-www-form-urlencoded'
             }
         )
+        self.get_oauth_token()
 
-    def get_oauth_token(self):
-
+    def get_oauth_token(self, force=False):
 
         """
         Obtains an OAuth2.0 access token from Azure AD using msal library ConfidentialClientApplication class, as recommended by Microsoft.
 
-        This method handles the OAuth2.0 authentication process and retrieves an access token
-        required for making the API requests.
+        The token is looked up first in the process-wide cache and then in the persistent cache (file or Prefect block),
+        and a new one is only requested when none of them holds a token valid for more than refresh_margin seconds.
+        The msal application is created once per authority and client id and reused by every client.
+
+        Args:
+            force (bool): request a new token even if a cached one has not expired (e.g. after a 401 response).
         """
 
-        auth_client = ConfidentialClientApplication(
-        client_id=self.client_id,
-        client_credential=self.client_secret,
-        authority=self.authority
-        )   
-    
-        token_response = auth_client.acquire_token_for_client(scopes=self.scopes)
+        key = f'{self.authority}|{self.client_id}|{" ".join(self.scopes)}'
 
-        if 'access_token' in token_response:
+        with _token_cache_lock:
 
-            self.access_token = token_response['access_token']   
-            self.token_type = token_response['token_type'] 
+            token = None if force else _token_cache.get(key)
 
-        else:
+            if not self.is_valid(token) and not force:
+
+                token = self.read_persistent_token(key)
+
+            if not self.is_valid(token):
+
+                #msal returns the token from its own cache until it expires, so a forced refresh (e.g. after a 401)
+                #creates a new application instead of getting the rejected token back
+
+                if force or key not in _auth_clients:
+
+                    _auth_clients[key] = ConfidentialClientApplication(
+                    client_id=self.client_id,
+                    client_credential=self.client_secret,
+                    authority=self.authority
+                    )
 
-            raise Exception(f'''Unable to obtain access token with parameters provided.
+                token_response = _auth_clients[key].acquire_token_for_client(scopes=self.scopes)
+
+                if 'access_token' not in token_response:
+
+                    raise Exception(f'''Unable to obtain access token with parameters provided.
                              client_id : {self.client_id}
-                             client_secret : {self.client_secret}
-                             authority : {self.authority}''')
+                             authority : {self.authority}
+                             error : {token_response.get('error_description')}''')
+
+                token = {
+
+                    'access_token' : token_response['access_token'],
+                    'token_type' : token_response['token_type'],
+                    'expires_at' : time.time() + int(token_response.get('expires_in', 3599))
+                }
+
+                self.write_persistent_token(key, token)
+
+            _token_cache[key] = token
+
+        self.access_token = token['access_token']
+        self.token_type = token['token_type']
+        self.expires_at = token['expires_at']
+        self.headers['Authorization'] = f'{self.token_type} {self.access_token}'
+
+    def is_valid(self, token):
+
+        return token is not None and token['expires_at'] - self.refresh_margin > time.time()
+
+    def read_persistent_token(self, key):
+
+        """
+        Returns the token stored under key in the persistent cache, or None if there is no persistent cache or entry.
+        """
+
+        if self.token_cache_block:
+
+            from prefect.blocks.system import Secret
+
+            try:
+
+                return json.loads(Secret.load(self.token_cache_block).get()).get(key)
+
+            except ValueError:
+
+                return None
+
+        if self.token_cache_path and exists(self.token_cache_path):
+
+            with open(self.token_cache_path, 'r') as file:
+
+                return json.load(file).get(key)
+
+        return None
+
+    def write_persistent_token(self, key, token):
+
+        """
+        Stores the token under key in the persistent cache, keeping the tokens of other clients.
+        """
+
+        if self.token_cache_block:
+
+            from prefect.blocks.system import Secret
+
+            try:
+
+                tokens = json.loads(Secret.load(self.token_cache_block).get())
+
+            except ValueError:
+
+                tokens = {}
+
+            tokens[key] = token
+
+            #tokens are stored in a Secret block so they are not displayed on the Prefect UI
+
+            Secret(value=json.dumps(tokens)).save(name=self.token_cache_block, overwrite=True)
+
+        elif self.token_cache_path:
+
+            tokens = {}
+
+            if exists(self.token_cache_path):
+
+                with open(self.token_cache_path, 'r') as file:
+
+                    tokens = json.load(file)
+
+            tokens[key] = token
+
+            #the tokens are written to a temporary file that replaces the cache, so a failure does not leave an incomplete file.
+            #the file holds bearer tokens, so it is created readable and writable by the owner only (0600).
+
+            descriptor = os_open(f'{self.token_cache_path}.tmp', O_WRONLY | O_CREAT | O_TRUNC, 0o600)
+
+            fchmod(descriptor, 0o600)
+
+            with fdopen(descriptor, 'w') as file:
+
+                json.dump(tokens, file)
+
+            replace(f'{self.token_cache_path}.tmp', self.token_cache_path)
         
-    def refresh_oauth_token(self):
+    def refresh_oauth_token(self, force=False):
 
         """
-        Obtains a new OAuth2.0 access token once the current session token expired.
+        Refreshes the OAuth2.0 access token ahead of its expiration, or immediately when force is True.
+        Safe to call from concurrent page fetches: only the first thread to find an expiring token requests a new one.
         """
 
-        self.get_oauth_token()
+        if force or self.expires_at - self.refresh_margin <= time.time():
+
+            with self.token_lock:
+
+                if force or self.expires_at - self.refresh_margin <= time.time():
+
+                    self.get_oauth_token(force=force)
 
     
     def request(self, url, method, params=None):
@@ -116,35 +267,166 @@ class BusinessCentralAPIClient(requests.Session):
         pagination for 'GET' requests using @OData.nextLink annotation as per OData standard.
         """
 
+        if method == 'GET':
+
+            rows = []
+
+            for page in self.iter_pages(url, params):
+
+                rows.extend(page)
+            
+            return rows
+
+        response = self.send_request(url, method, params)
+
+        return response.json()
+
+    def iter_pages(self, url, params=None):
+
+        """
+        Generator that yields the records of a GET request one page at a time, following the @odata.nextLink annotation.
+        Each page payload is parsed exactly once.
+        """
+
+        response = self.send_request(url, 'GET', params)
+
+        data = response.json()
+
+        yield data.get('value')
+
+        nextLink = data.get('@odata.nextLink')
+
+        while nextLink:
+
+            data = self.send_request(nextLink, 'GET').json()
+
+            yield data['value']
+
+            nextLink = data.get('@odata.nextLink')
+
+    def send_request(self, url, method, params=None):
+
         endpoint = urllib.parse.urljoin(self.base_url,url)
 
+        self.refresh_oauth_token()
+
         response = super().request(url=endpoint,method=method,headers=self.headers,params=params)
 
         if response.status_code == 401:
 
-            self.refresh_oauth_token()
+            self.refresh_oauth_token(force=True)
             
             response = super().request(url=endpoint,method=method,headers=self.headers,params=params)
 
         
         response.raise_for_status()
 
-        if method == 'GET':
+        return response
+
+    def request_partitioned(self, url, params, partition_key, partitions):
+
+        """
+        Splits a GET request into key ranges of an integer field using $filter and fetches the partitions concurrently,
+        each one following its own @odata.nextLink chain. Results are merged in key range order.
 
-            nextLink = response.json().get('@odata.nextLink')
+        Args:
+            url (str): the endpoint of the request, relative to base_url.
+            params (dict): the OData query options of the request.
+            partition_key (str): an integer field of the API page used to split the request (e.g. entryNo).
+            partitions (int): the number of key ranges to fetch.
 
-            while nextLink:
+        Returns:
+            A list of records in json format.
+        """
 
-                nextLink_response = super().request(url=nextLink,method=method,headers=self.headers)
-                nextLink_response.raise_for_status()
+        partition_params = self.partition_params(url, params, partition_key, partitions)
 
-                response.json()['value'].extend(nextLink_response.json()['value'])
+        def fetch(key_range_params):
 
-                nextLink = nextLink_response.json().get('@odata.nextLink')
-            
-            return response.json().get('value')
+            return self.request(url=url, method='GET', params=key_range_params)
 
-        return response.json()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+
+            results = list(executor.map(fetch, partition_params))
+
+        rows = []
+
+        for partition in results:
+
+            rows.extend(partition)
+
+        return rows
+
+    def partition_params(self, url, params, partition_key, partitions):
+
+        """
+        Returns one copy of params per key range of partition_key, each one restricted to its range with $filter,
+        or an empty list if no records match the $filter in params.
+        """
+
+        bounds = self.get_key_bounds(url, params, partition_key)
+
+        if bounds is None:
+
+            return []
+
+        low, high = bounds
+
+        step = ceil((high - low + 1) / partitions)
+
+        ranges = [(start, min(start + step, high + 1)) for start in range(low, high + 1, step)]
+
+        return [self.add_filter(params, f'{partition_key} ge {start} and {partition_key} lt {end}') for start, end in ranges]
+
+    def get_key_bounds(self, url, params, partition_key):
+
+        """
+        Returns the minimum and maximum values of partition_key among the records matching the $filter in params,
+        or None if no records match.
+        """
+
+        bounds = []
+
+        for direction in ('asc', 'desc'):
+
+            bound_params = {k: v for k, v in params.items() if k not in ('$skip', '$top', '$orderby', '$select')}
+
+            bound_params.update(
+                {
+                    '$select' : partition_key,
+                    '$orderby' : f'{partition_key} {direction}',
+                    '$top' : '1'
+                }
+            )
+
+            rows = self.request(url=url, method='GET', params=bound_params)
+
+            if not rows:
+
+                return None
+
+            bounds.append(int(rows[0][partition_key]))
+
+        return tuple(bounds)
+
+    @staticmethod
+    def add_filter(params, expression):
+
+        """
+        Returns a copy of params with expression combined into its $filter query option.
+        """
+
+        params = dict(params)
+
+        if '$filter' in params:
+
+            params['$filter'] = f"({params['$filter']}) and ({expression})"
+
+        else:
+
+            params['$filter'] = expression
+
+        return params
     
     def create_parameters(self,createdAt,modifiedAt,orderBy,select,offset,limit,filterExpression):
         """
@@ -157,7 +439,7 @@ class BusinessCentralAPIClient(requests.Session):
             modifiedAt (datetime): The value to filter records modified after a specific timestamp.
             (it is required that systemModifiedAt field is included on the API page to use this parameter).
             orderBy (str): The field of the API response to order by.
-            select (str): The fields to include in the API response.
+            select (str or list): The fields to include in the API response.
             offset (int): The number of records to skip in the API response.
             limit (int): The maximum number of records to return in the API response.
             filterExpression (str): A custom filter expression to apply to the request.
@@ -176,7 +458,7 @@ class BusinessCentralAPIClient(requests.Session):
 
             if '$filter' in self.params:
 
-                self.params['$filter'] =+ f' and ()systemModifiedAt gt {modifiedAt})'
+                self.params['$filter'] += f' and (systemModifiedAt gt {modifiedAt})'
 
             else:
                 
@@ -195,6 +477,10 @@ class BusinessCentralAPIClient(requests.Session):
             )
 
         if select:
+
+            if isinstance(select,(list,tuple)):
+
+                select = ','.join(select)
             
             self.params.update(
                 {
@@ -223,7 +509,7 @@ class BusinessCentralAPIClient(requests.Session):
 
             if '$filter' in self.params:
 
-                self.params['$filter'] =+ f' and ({filterExpression})'
+                self.params['$filter'] += f' and ({filterExpression})'
 
             else:
 
@@ -232,8 +518,162 @@ class BusinessCentralAPIClient(requests.Session):
                         '$filter':f'{filterExpression}'
                     }
                 )
+
+        return self.params
             
     
+    def get_with_odata_parameters(self,api_page,createdAt=None,modifiedAt=None,orderBy=None,select=None,offset=None,limit=None,
+                                  filterExpression=None,partitions=1,partition_key=None):
+
+        """get a list of records from any API page using OData query options.
+
+            Args:
+            api_page (str): the name of the API page entity. (required)
+            createdAt (datetime): retrieve records created after a specific timestamp. (optional)
+            modifiedAt (datetime): retrieve records modified after a specific timestamp (optional)
+            orderBy (str): order results by a specific field (optional)
+            select (str or list): specify the fields to include on the api response (optional)
+            offset (int): the number of records to skip in the API response. (optional)
+            limit (int): the maximum number of records to return in the API response. (optional)
+            filterExpression (str): a custom filter expression to apply to the request. (optional)
+            partitions (int): the number of key ranges fetched concurrently, ignored when offset or limit are used. (optional)
+            partition_key (str): the integer field used to split the request into partitions. (optional)
+
+            Returns:
+            A list of records from the API page in json format.
+        """
+
+        params = self.create_parameters(createdAt,modifiedAt,orderBy,select,offset,limit,filterExpression)
+
+        if partitions > 1 and partition_key and not (offset or limit):
+
+            return self.request_partitioned(url=api_page,params=params,partition_key=partition_key,partitions=partitions)
+
+        return self.request(url=api_page,method='GET',params=params)
+
+    def iter_records(self,api_page,createdAt=None,modifiedAt=None,orderBy=None,select=None,offset=None,limit=None,filterExpression=None):
+
+        """iterate over the records of any API page one page at a time, so callers can process each batch as it arrives.
+
+            Args:
+            api_page (str): the name of the API page entity. (required)
+            createdAt (datetime): retrieve records created after a specific timestamp. (optional)
+            modifiedAt (datetime): retrieve records modified after a specific timestamp (optional)
+            orderBy (str): order results by a specific field (optional)
+            select (str or list): specify the fields to include on the api response (optional)
+            offset (int): the number of records to skip in the API response. (optional)
+            limit (int): the maximum number of records to return in the API response. (optional)
+            filterExpression (str): a custom filter expression to apply to the request. (optional)
+
+            Returns:
+            A generator of lists of records in json format, one list per page.
+        """
+
+        params = self.create_parameters(createdAt,modifiedAt,orderBy,select,offset,limit,filterExpression)
+
+        return self.iter_pages(url=api_page,params=params)
+
+    def iter_record_partitions(self,api_page,createdAt=None,modifiedAt=None,orderBy=None,select=None,filterExpression=None,
+                               partitions=1,partition_key=None):
+
+        """split a request on any API page into key ranges and return one page iterator per range, so callers can consume
+            the ranges concurrently while processing each page as it arrives.
+
+            Args:
+            api_page (str): the name of the API page entity. (required)
+            createdAt (datetime): retrieve records created after a specific timestamp. (optional)
+            modifiedAt (datetime): retrieve records modified after a specific timestamp (optional)
+            orderBy (str): order results by a specific field (optional)
+            select (str or list): specify the fields to include on the api response (optional)
+            filterExpression (str): a custom filter expression to apply to the request. (optional)
+            partitions (int): the number of key ranges, a single iterator over the whole request is returned when it is 1. (optional)
+            partition_key (str): the integer field used to split the request into partitions. (optional)
+
+            Returns:
+            A list of generators of lists of records in json format, one generator per key range.
+        """
+
+        params = self.create_parameters(createdAt,modifiedAt,orderBy,select,None,None,filterExpression)
+
+        if partitions > 1 and partition_key:
+
+            return [self.iter_pages(url=api_page,params=_) for _ in self.partition_params(api_page,params,partition_key,partitions)]
+
+        return [self.iter_pages(url=api_page,params=params)]
+
+    def get_records_by_ids(self,api_page,ids,key='no',select=None,max_url_length=2000):
+
+        """get the records matching a list of ids from any API page, grouping the lookups into OR-ed $filter expressions
+            chunked by URL length, so a list of ids is resolved in a few requests instead of one request per id.
+            Chunks are fetched concurrently up to max_concurrency.
+
+            Args:
+            api_page (str): the name of the API page entity. (required)
+            ids (iterable): the values of the key field to look up. (required)
+            key (str): the field of the API page compared against ids, 'no' by default. (optional)
+            select (str or list): specify the fields to include on the api response, key is always included (optional)
+            max_url_length (int): the maximum length of the request URL, including the query string. (optional)
+
+            Returns:
+            A dict of records in json format keyed by id, ids without a matching record are not included.
+        """
+
+        if select:
+
+            select = select.split(',') if isinstance(select,str) else list(select)
+
+            if key not in select:
+
+                select.append(key)
+
+        params = self.create_parameters(None,None,None,select,None,None,None)
+
+        base_length = len(urllib.parse.urljoin(self.base_url,api_page)) + len(urllib.parse.urlencode(params)) + len('&$filter=')
+
+        chunks = []
+        expressions = []
+        length = base_length
+
+        for _ in dict.fromkeys(ids):
+
+            value = str(_).replace("'", "''")
+
+            expression = urllib.parse.quote(f"{key} eq '{value}'")
+
+            separator = len(urllib.parse.quote(' or ')) if expressions else 0
+
+            if expressions and length + separator + len(expression) > max_url_length:
+
+                chunks.append(expressions)
+                expressions = []
+                length = base_length
+                separator = 0
+
+            expressions.append(f"{key} eq '{value}'")
+            length += separator + len(expression)
+
+        if expressions:
+
+            chunks.append(expressions)
+
+        def fetch(chunk):
+
+            return self.request(url=api_page,method='GET',params={**params, '$filter' : ' or '.join(chunk)})
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+
+            results = list(executor.map(fetch, chunks))
+
+        records = {}
+
+        for rows in results:
+
+            for row in rows:
+
+                records[row[key]] = row
+
+        return records
+
     def get_customers(self,createdAt=None,modifiedAt=None,orderBy=None,select=None,offset=None,limit=None,filterExpression=None):
 
         """get a list of customers for the specific company.
@@ -310,6 +750,36 @@ class BusinessCentralAPIClient(requests.Session):
 
         return self.get_products(filterExpression=f"no eq '{productId}'")
 
+    def get_customers_by_ids(self,customerIds,select=None):
+
+        """get information about a list of customers in a few requests.
+
+            Args:
+            customerIds (iterable): the unique identifiers of the customers, found on the 'no' field of the API Page. (required)
+            select (str or list): specify the fields to include on the api response (optional)
+
+            Returns:
+
+            A dict of customer records in json format keyed by customer id.
+        """
+
+        return self.get_records_by_ids(self.CUSTOMER_TABLE_ENDPOINT,customerIds,select=select)
+
+    def get_products_by_ids(self,productIds,select=None):
+
+        """get information about a list of products in a few requests.
+
+            Args:
+            productIds (iterable): the unique identifiers of the products, found on the 'no' field of the API Page. (required)
+            select (str or list): specify the fields to include on the api response (optional)
+
+            Returns:
+
+            A dict of product records in json format keyed by product id.
+        """
+
+        return self.get_records_by_ids(self.PRODUCT_TABLE_ENDPOINT,productIds,select=select)
+
     
 
 
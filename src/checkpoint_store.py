@@ -0,0 +1,117 @@
+import json
+from os import replace
+from os.path import exists
+from datetime import datetime
+from threading import Lock
+from pandas import DataFrame
+from sqlalchemy import MetaData, Table, Column, String, Text, DateTime, select
+
+
+class CheckpointStore:
+
+    """
+    Stores the high-water marks of incremental extracts, keyed by flow, table and environment.
+
+    Checkpoints are written after each successful commit and read at flow start, so extracts do not need
+    to derive their state from MAX() scans over the target tables. Values are stored as JSON, which means
+    dates must be stored as ISO strings by the caller.
+
+    Attributes:
+
+        flow (str) : name of the flow that owns the checkpoints.
+        environment (str) : environment of the source system (e.g. Involves environment id).
+        SQLSession (SQLServerEngine) : engine used to store checkpoints on a SQL table. (optional)
+        path (str) : path of a local JSON file used to store checkpoints when no SQLSession is provided. (optional)
+        table (str) : name of the SQL table that holds the checkpoints, created if it does not exist.
+    """
+
+    def __init__(self, flow, environment, SQLSession=None, path=None, table='Checkpoint'):
+
+        if SQLSession is None and path is None:
+
+            raise ValueError('A SQLSession or a path is required to store checkpoints')
+
+        self.flow = flow
+        self.environment = str(environment)
+        self.SQLSession = SQLSession
+        self.path = path
+        self.table = table
+        self.lock = Lock()
+
+        if self.SQLSession is not None:
+
+            metadata = MetaData()
+
+            checkpoint_table = Table(self.table, metadata,
+                                     Column('flow', String(100), primary_key=True),
+                                     Column('table_name', String(100), primary_key=True),
+                                     Column('environment', String(50), primary_key=True),
+                                     Column('value', Text),
+                                     Column('updated_at', DateTime))
+
+            checkpoint_table.create(self.SQLSession.engine, checkfirst=True)
+
+    def get(self, table, default=None):
+
+        if self.SQLSession is not None:
+
+            checkpoint_table = self.SQLSession.get_table(self.table)
+
+            query = select([checkpoint_table.c.value]).where(
+                (checkpoint_table.c.flow == self.flow) &
+                (checkpoint_table.c.table_name == table) &
+                (checkpoint_table.c.environment == self.environment)
+            )
+
+            r = self.SQLSession.execute_query(query)
+
+            return json.loads(r[0][0]) if r else default
+
+        with self.lock:
+
+            return self.read_file().get(self.key(table), default)
+
+    def set(self, table, value):
+
+        if self.SQLSession is not None:
+
+            row = {
+
+                'flow' : self.flow,
+                'table_name' : table,
+                'environment' : self.environment,
+                'value' : json.dumps(value),
+                'updated_at' : datetime.now()
+            }
+
+            self.SQLSession.upsert_from_df(self.table, DataFrame([row]), ['flow','table_name','environment'])
+
+            return
+
+        with self.lock:
+
+            checkpoints = self.read_file()
+
+            checkpoints[self.key(table)] = value
+
+            #se escribe a un archivo temporal y se reemplaza para no dejar el archivo incompleto ante una falla
+
+            with open(f'{self.path}.tmp', 'w') as file:
+
+                json.dump(checkpoints, file, indent=4)
+
+            replace(f'{self.path}.tmp', self.path)
+
+    def key(self, table):
+
+        return f'{self.flow}/{table}/{self.environment}'
+
+    def read_file(self):
+
+        if not exists(self.path):
+
+            return {}
+
+        with open(self.path, 'r') as file:
+
+            return json.load(file)
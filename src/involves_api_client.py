@@ -4,8 +4,12 @@ from os import getcwd
 project_dir = abspath(join(getcwd(), './'))
 sys.path.insert(0, project_dir)
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from requests import Session
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 from utils.utilities import extract_json_keys
 
 
@@ -15,7 +19,9 @@ class InvolvesAPIClient(Session):
                  environment,
                  domain,
                  username,
-                 password):
+                 password,
+                 max_concurrency=8,
+                 retries=3):
 
         super().__init__()
         
@@ -24,6 +30,14 @@ class InvolvesAPIClient(Session):
         self.password = password
         self.auth = HTTPBasicAuth(self.username,self.password)
         self.base_url = f'https://{domain}.involves.com/webservices/api' 
+        self.max_concurrency = max_concurrency
+
+        #un pool de conexiones por cada descarga concurrente, y reintentos por solicitud ante errores temporales del servidor
+
+        retry = Retry(total=retries,backoff_factor=1,status_forcelist=[429,500,502,503,504],allowed_methods=['GET'])
+
+        adapter = HTTPAdapter(pool_connections=1,pool_maxsize=self.max_concurrency,max_retries=retry)
+        self.mount('https://',adapter)
 
         self.headers.update({
 
@@ -34,53 +48,117 @@ class InvolvesAPIClient(Session):
 
     def request(self, url, method, params=None):
 
-        response = super().request(url=url,method=method,headers=self.headers,params=params)
+        if method == 'GET':
 
-        response.raise_for_status()
+            data, params = self.request_first_page(url,params)
 
-        if method == 'GET':
+            if 'totalPages' in data:
+
+                rows = list(self.extract_items(data))
 
-            if params:
+                for items in self.iter_remaining_pages(url,params,data.get('totalPages')):
 
-                params.update({
-                    'size':200
-                })
+                    rows.extend(items)
+
+                return rows
             
             else:
 
-                params = {
-                    'size':200
-                }
+                return data
+        
+        response = super().request(url=url,method=method,headers=self.headers,params=params)
+
+        response.raise_for_status()
 
+    def iter_pages(self, url, params=None):
 
-            if 'totalPages' in response.json():
+        #generador que devuelve los registros de cada pagina en orden, conforme se van descargando
 
-                    rows = []
-                    page = 1
-                    totalPages = response.json().get('totalPages')
+        data, params = self.request_first_page(url,params)
 
-                    while page <= totalPages:
-                         
-                         params.update({
-                              'page' : page
-                            })
-                         
-                         response = super().request(url=url,method=method, headers=self.headers, params=params)
+        if 'totalPages' in data:
 
-                         if 'items' in response.json():
-                              
-                            rows.extend(response.json().get('items'))
-                        
-                         elif 'itens' in response.json():
+            yield self.extract_items(data)
 
-                            rows.extend(response.json().get('itens'))
-                        
-                         page += 1
+            yield from self.iter_remaining_pages(url,params,data.get('totalPages'))
 
-                    return rows
-            else:
+        else:
+
+            yield data
+
+    def iter_items(self, url, params=None, select=None):
+
+        for items in self.iter_pages(url,params):
+
+            yield self.select_fields(data=items,fields=select)
+
+    def request_first_page(self, url, params=None):
+
+        params = dict(params) if params else {}
+
+        params.update({
+            'size':200
+        })
+
+        response = super().request(url=url,method='GET',headers=self.headers,params=params)
+
+        response.raise_for_status()
+
+        return response.json(), params
+
+    def iter_remaining_pages(self, url, params, totalPages):
+
+        #las paginas 2..N se descargan en paralelo
+
+        yield from self.map_concurrent(lambda page: self.request_page(url,'GET',params,page),range(2,totalPages + 1))
+
+    def map_concurrent(self, fn, iterable):
+
+        #aplica fn en paralelo sobre iterable y devuelve los resultados en el orden original,
+        #manteniendo como maximo max_concurrency resultados en memoria
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
 
-                return response.json()
+            pending = deque()
+
+            for value in iterable:
+
+                pending.append(executor.submit(fn,value))
+
+                if len(pending) >= self.max_concurrency:
+
+                    yield pending.popleft().result()
+
+            while pending:
+
+                yield pending.popleft().result()
+
+    def request_page(self, url, method, params, page):
+
+        page_params = dict(params)
+
+        page_params.update({
+            'page' : page
+        })
+
+        response = super().request(url=url,method=method,headers=self.headers,params=page_params)
+
+        response.raise_for_status()
+
+        return self.extract_items(response.json())
+    
+    @staticmethod
+    def extract_items(data):
+
+        if 'items' in data:
+
+            return data.get('items')
+        
+        elif 'itens' in data:
+
+            return data.get('itens')
+        
+        return []
     
     @staticmethod
     def create_params(**kwargs):
@@ -141,6 +219,12 @@ class InvolvesAPIClient(Session):
 
         return self.select_fields(data=data,fields=select) 
     
+    def iter_pointsofsale(self,name=None,active=None,updatedAtMillis=None,select=None):
+
+        params = self.create_params(name=name,active=active,updatedAtMillis=updatedAtMillis)
+
+        return self.iter_items(url=f'{self.base_url}/v1/{self.environment}/pointofsale',params=params,select=select)
+    
     def get_pointofsale_by_id(self,pointOfSaleId):
 
         return self.request(url=f'{self.base_url}/v3/environments/{self.environment}/pointofsales/{pointOfSaleId}',method='GET')
@@ -179,6 +263,12 @@ class InvolvesAPIClient(Session):
 
         return self.select_fields(data=data,fields=select) 
     
+    def iter_employees(self,regionId=None,formId=None,name=None,active=None,updatedAtMillis=None,select=None):
+
+        params = self.create_params(regionId=regionId,formId=formId,name=name,active=active,updatedAtMillis=updatedAtMillis)
+
+        return self.iter_items(url=f'{self.base_url}/v1/{self.environment}/employeeenvironment',params=params,select=select)
+    
     def get_employee_by_id(self,employeeId):
 
         return self.request(url=f'{self.base_url}/v3/environments/{self.environment}/employees/{employeeId}',method='GET')
@@ -226,6 +316,10 @@ class InvolvesAPIClient(Session):
 
         data = self.request(url=f'{self.base_url}/v3/environments/{self.environment}/surveys/{surveyId}',method='GET')
         return self.select_fields(data=data,fields=select)
+
+    def iter_survey_responses(self,surveyIds,select=None):
+
+        return self.map_concurrent(lambda surveyId: self.get_survey_response_by_id(surveyId,select=select),surveyIds)
     
     def get_channels(self):
 
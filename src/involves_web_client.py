@@ -0,0 +1,165 @@
+import sys
+from os.path import abspath, join
+from os import getcwd
+project_dir = abspath(join(getcwd(), './'))
+sys.path.insert(0, project_dir)
+
+from io import BytesIO
+from urllib.parse import urlparse
+from threading import Lock
+from requests import Session, RequestException
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from utils.utilities import format_involves_date, read_visits_report, VISIT_PANEL_PAGE_IDS
+
+
+class InvolvesSessionError(RequestException):
+
+    """
+    Raised when the web application answers with the login page instead of the report, usually because the session expired.
+    Subclass of RequestException so visit_bot_retry_fn retries the task with a new session.
+    """
+
+
+class InvolvesWebClient(Session):
+
+    """
+    Session based client for the Involves web application, replays the requests made by the visits panel
+    to export the 'informe gerencial' report without driving a browser.
+
+    The login and export paths are configurable, so the client can be pointed to a local stand-in server
+    or adjusted if the web application changes its routes.
+
+    The login form fields, the export path and its parameters have not been verified against a network trace of
+    the web application yet, and the tests only cover the stand-in server in tests/involves_stub_server.py, which
+    implements the same assumptions. Until the requests are captured from the real application and this client is
+    coded against them, the production flows keep exporting the report with the browser.
+
+    Attributes:
+
+        environment (int) : Involves environment id, selects the visits panel of the report.
+        domain (str) : Involves domain, used to build the base url when base_url is not provided.
+        username (str) : web application username.
+        password (str) : web application password.
+        base_url (str) : root url of the web application. (optional)
+        login_path (str) : path of the login form, relative to base_url.
+        export_path (str) : path of the visits report export, relative to base_url.
+        timeout (int) : seconds to wait for each response, the export of large date ranges can take a while.
+        session_cookie (str) : name of the cookie that holds the web application session.
+    """
+
+    def __init__(self,
+                 environment,
+                 domain,
+                 username,
+                 password,
+                 base_url=None,
+                 login_path='/login',
+                 export_path='/webapp/visitpanel/report/export',
+                 timeout=120,
+                 retries=3,
+                 session_cookie='JSESSIONID'):
+
+        super().__init__()
+
+        self.environment = environment
+        self.username = username
+        self.password = password
+        self.base_url = (base_url or f'https://{domain}.involves.com').rstrip('/')
+        self.login_path = login_path
+        self.export_path = export_path
+        self.timeout = timeout
+        self.session_cookie = session_cookie
+        self.logged_in = False
+        self.session_number = 0
+        self.login_lock = Lock()
+
+        retry = Retry(total=retries,backoff_factor=1,status_forcelist=[429,500,502,503,504],allowed_methods=['GET'])
+
+        self.mount(self.base_url,HTTPAdapter(max_retries=retry))
+
+    def login(self):
+
+        #el formulario de inicio de sesion devuelve la cookie de sesion que usan las solicitudes siguientes y redirige
+        #a la aplicacion; si las credenciales no son validas la redireccion vuelve a la pagina de login
+
+        self.cookies.clear()
+
+        response = self.post(f'{self.base_url}{self.login_path}',
+                             data={'username' : self.username, 'password' : self.password},
+                             timeout=self.timeout)
+
+        response.raise_for_status()
+
+        if self.is_login_page(response) or self.session_cookie not in self.cookies:
+
+            raise PermissionError(f'No se obtuvo una sesion valida en {self.base_url}{self.login_path}')
+
+        self.logged_in = True
+
+        self.session_number += 1
+
+    def ensure_session(self):
+
+        #los hilos de la recuperacion de visitas comparten el cliente: el inicio de sesion se hace bajo el lock, asi solo
+        #un hilo limpia las cookies y los demas esperan la sesion nueva. Devuelve el numero de la sesion vigente
+
+        with self.login_lock:
+
+            if not self.logged_in:
+
+                self.login()
+
+            return self.session_number
+
+    def invalidate_session(self, session_number):
+
+        #solo se descarta la sesion con la que se hizo la solicitud; si otro hilo ya inicio una sesion nueva, se conserva
+
+        with self.login_lock:
+
+            if self.session_number == session_number:
+
+                self.logged_in = False
+
+    def export_visits(self, date, end_date=None):
+
+        """
+        Requests the visits report from date onwards (up to end_date, if provided) and returns the XLSX file content.
+        """
+
+        session_number = self.ensure_session()
+
+        params = {
+
+            'pageId' : VISIT_PANEL_PAGE_IDS[self.environment],
+            'startDate' : format_involves_date(date),
+            'report' : 'report.custom.columns',
+            'showHiddenColumns' : 'true'
+        }
+
+        if end_date is not None:
+
+            params['endDate'] = format_involves_date(end_date)
+
+        response = self.get(f'{self.base_url}{self.export_path}',params=params,timeout=self.timeout)
+
+        response.raise_for_status()
+
+        #los archivos XLSX son zip, una respuesta distinta suele ser la pagina de inicio de sesion por una sesion expirada
+
+        if self.is_login_page(response) or not response.content.startswith(b'PK'):
+
+            self.invalidate_session(session_number)
+
+            raise InvolvesSessionError(f'La respuesta de {self.export_path} no es un archivo XLSX', response=response)
+
+        return response.content
+
+    def is_login_page(self, response):
+
+        return urlparse(response.url).path.rstrip('/') == self.login_path.rstrip('/')
+
+    def download_visits(self, date, end_date=None):
+
+        return read_visits_report(BytesIO(self.export_visits(date, end_date)), self.environment)
@@ -1,25 +1,109 @@
-from sqlalchemy import create_engine, MetaData, Table, select, and_
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, select, and_, text, func, bindparam
 from datetime import datetime
+from os import remove
+from os.path import exists
+from threading import Lock
+import pickle
 from sqlalchemy.exc import IntegrityError,OperationalError,SQLAlchemyError
 from sqlalchemy.orm import sessionmaker
 
+
+#engines compartidos por todas las instancias del proceso, por url de conexion, para que las tareas concurrentes
+#y los subflujos reutilicen las conexiones abiertas del pool en lugar de autenticarse de nuevo con ODBC
+
+_engines = {}
+_engines_lock = Lock()
+
+
 class SQLServerEngine:
 
-    def __init__(self,engine_type='mssql',server=None,database=None):
+    def __init__(self,engine_type='mssql',server=None,database=None,chunk_size=10000,schema_snapshot=None,
+                 pool_size=10,max_overflow=10,pool_recycle=1800,pool_pre_ping=True):
 
         self.engine_type = engine_type
         self.server = server
         self.database = database
+        self.chunk_size = chunk_size
+        self.schema_snapshot = schema_snapshot
+        self.metadata = MetaData()
+        self.reflection_lock = Lock()
+
+        #el snapshot en disco evita reflejar de nuevo las tablas al iniciar el proceso
+
+        if self.schema_snapshot and exists(self.schema_snapshot):
+
+            with open(self.schema_snapshot,'rb') as file:
+
+                self.metadata = pickle.load(file)
         
         if self.engine_type == 'mssql':
             self.connection_url = f'mssql+pyodbc://{self.server}/{self.database}?driver=ODBC+Driver+17+for+SQL+Server&trusted_connection=yes'
+            engine_options = {
+                'fast_executemany' : True,
+                'pool_size' : pool_size,
+                'max_overflow' : max_overflow,
+                'pool_recycle' : pool_recycle,
+                'pool_pre_ping' : pool_pre_ping
+            }
         elif self.engine_type == 'sqlite':
             self.connection_url = f'sqlite:///{database}'
+            engine_options = {'pool_pre_ping' : pool_pre_ping}
+
+        #la configuracion del pool solo aplica a la primera instancia creada para cada url de conexion
+
+        with _engines_lock:
+
+            if self.connection_url not in _engines:
+
+                _engines[self.connection_url] = create_engine(self.connection_url,**engine_options)
+
+            self.engine = _engines[self.connection_url]
 
-        self.engine = create_engine(self.connection_url)
         self.Session = sessionmaker(bind=self.engine)
 
 
+    def get_table(self, table_name):
+
+        #refleja cada tabla una sola vez y la conserva en self.metadata para las siguientes operaciones
+
+        with self.reflection_lock:
+
+            if table_name not in self.metadata.tables:
+
+                Table(table_name, self.metadata, autoload=True, autoload_with=self.engine)
+
+                self.save_schema_snapshot()
+
+            return self.metadata.tables[table_name]
+
+    def invalidate_table(self, table_name=None):
+
+        #descarta la definicion en cache de una tabla (o de todas) para volver a reflejarla en el siguiente uso
+
+        with self.reflection_lock:
+
+            if table_name is None:
+
+                self.metadata.clear()
+
+            elif table_name in self.metadata.tables:
+
+                self.metadata.remove(self.metadata.tables[table_name])
+
+            if self.schema_snapshot and exists(self.schema_snapshot):
+
+                remove(self.schema_snapshot)
+
+            self.save_schema_snapshot()
+
+    def save_schema_snapshot(self):
+
+        if self.schema_snapshot and self.metadata.tables:
+
+            with open(self.schema_snapshot,'wb') as file:
+
+                pickle.dump(self.metadata,file)
+
     def execute_query(self,query):
         
         with self.engine.connect() as c:
@@ -37,13 +121,81 @@ class SQLServerEngine:
     
     def get_set_of_unique_values(self,table,column):
 
-        r = self.execute_query(f'''
-                                  SELECT DISTINCT
-                                  {column} FROM {table}''')
+        table = self.get_table(table)
+
+        r = self.execute_query(select([table.c[column]]).distinct())
         
         return set([row[0] for row in r])
     
-    def bulk_insert_from_df(self,table_data):
+    def insert_rows(self, connection, table, df, chunk_size=None):
+
+        #envia los registros en bloques de chunk_size como tuplas armadas a partir de los arreglos de cada columna,
+        #sin convertir el DataFrame a una lista de diccionarios
+
+        chunk_size = chunk_size or self.chunk_size
+
+        columns = list(df.columns)
+
+        statement, processors = self.insert_statement(table, columns)
+
+        for start in range(0, len(df), chunk_size):
+
+            chunk = df.iloc[start:start + chunk_size]
+
+            arrays = []
+
+            for col, processor in zip(columns, processors):
+
+                values = chunk[col].tolist()
+
+                if processor:
+
+                    values = [processor(value) for value in values]
+
+                arrays.append(values)
+
+            connection.exec_driver_sql(statement, list(zip(*arrays)))
+
+    def insert_records(self, connection, table, rows, chunk_size=None):
+
+        #version de insert_rows para listas de diccionarios: las columnas son las llaves del primer registro
+        #y cada bloque se envia como tuplas, sin pasar por pandas
+
+        chunk_size = chunk_size or self.chunk_size
+
+        columns = list(rows[0].keys())
+
+        statement, processors = self.insert_statement(table, columns)
+
+        for start in range(0, len(rows), chunk_size):
+
+            arrays = []
+
+            for col, processor in zip(columns, processors):
+
+                values = [row.get(col) for row in rows[start:start + chunk_size]]
+
+                if processor:
+
+                    values = [processor(value) for value in values]
+
+                arrays.append(values)
+
+            connection.exec_driver_sql(statement, list(zip(*arrays)))
+
+    def insert_statement(self, table, columns):
+
+        #sentencia INSERT con parametros posicionales y los procesadores de tipo de cada columna para el dialecto del motor
+
+        quote = self.engine.dialect.identifier_preparer.quote
+
+        statement = f'INSERT INTO {quote(table.name)} ({", ".join(quote(col) for col in columns)}) VALUES ({", ".join("?" for _ in columns)})'
+
+        processors = [table.c[col].type.dialect_impl(self.engine.dialect).bind_processor(self.engine.dialect) for col in columns]
+
+        return statement, processors
+
+    def bulk_insert_from_df(self,table_data,chunk_size=None):
 
         try:
 
@@ -53,12 +205,9 @@ class SQLServerEngine:
 
                     if not df.empty:
 
-                        d = df.to_dict(orient='records')
-
-                        metadata = MetaData()
-                        table = Table(table_name, metadata, autoload=True, autoload_with=self.engine)
+                        table = self.get_table(table_name)
                 
-                        session.execute(table.insert(), d)
+                        self.insert_rows(session.connection(), table, df, chunk_size)
 
                 session.commit()
 
@@ -84,8 +233,7 @@ class SQLServerEngine:
 
             with self.Session() as session:
                     
-                metadata = MetaData()
-                table = Table(table_name, metadata, autoload=True, autoload_with=self.engine)
+                table = self.get_table(table_name)
 
                     
                 for data in update_data:
@@ -117,27 +265,297 @@ class SQLServerEngine:
             raise SQLAlchemyError(f'Error al intentar actualizar registros en la tabla {table_name}: {e}')
         
 
-        
-    def get_columns_from_table(self, table):
+    def bulk_insert_from_pydicts(self, pydict, table_name, chunk_size=None):
+
+        if not pydict:
+
+            return
+
+        try:
+
+            with self.engine.begin() as c:
+
+                table = self.get_table(table_name)
+
+                self.insert_records(c, table, pydict, chunk_size)
+
+            print(f'Se insertaron correctamente los nuevos registros en la tabla {table_name}. Se añadieron {len(pydict)} registros')
+
+        except Exception as e:
+
+            raise SQLAlchemyError(f'Error al intentar actualizar la tabla {table_name}: {e}')
+
+    def update_records_from_pydicts(self, table_name, pydict, primary_key, chunk_size=None):
+
+        #carga los registros en una tabla temporal y aplica un solo UPDATE ... FROM sobre la tabla destino,
+        #en lugar de una sentencia UPDATE por registro. Las llaves repetidas conservan el ultimo registro
+
+        if not pydict:
+
+            return 0
+
+        keys = self.primary_key_columns(primary_key)
+
+        rows = list({tuple(row[k] for k in keys) : row for row in pydict}.values())
+
+        columns = list(rows[0].keys())
+
+        values = [col for col in columns if col not in keys]
+
+        quote = self.engine.dialect.identifier_preparer.quote
+
+        try:
+
+            with self.engine.begin() as c:
+
+                table = self.get_table(table_name)
+
+                staging = self.create_staging_table(c,table,columns)
+
+                self.insert_records(c, staging, rows, chunk_size)
+
+                target = quote(table.name)
+                source = quote(staging.name)
+
+                if self.engine_type == 'mssql':
+
+                    statement = f'UPDATE t SET ' + ', '.join(f't.{quote(col)} = s.{quote(col)}' for col in values) + f' FROM {target} t JOIN {source} s ON {self.join_condition("t","s",keys)}'
+
+                elif self.engine_type == 'sqlite':
+
+                    statement = f'UPDATE {target} SET ' + ', '.join(f'{quote(col)} = s.{quote(col)}' for col in values) + f' FROM {source} AS s WHERE {self.join_condition(target,"s",keys)}'
+
+                updated = c.execute(text(statement)).rowcount if values else 0
+
+                c.execute(text(f'DROP TABLE {source}'))
+
+            print(f'Se actualizaron correctamente los registros de la tabla {table_name}. Se modificaron {updated} registros.')
+
+            return updated
+
+        except Exception as e:
+
+            raise SQLAlchemyError(f'Error al intentar actualizar registros en la tabla {table_name}: {e}')
+
+    def upsert_from_df(self, table_name, df, primary_key, skip_unchanged=False, ignore_columns=()):
+
+        #carga los registros en una tabla temporal y aplica un solo MERGE (mssql) o INSERT ... ON CONFLICT (sqlite)
+        #sobre la tabla destino, devolviendo el numero de registros insertados, actualizados y sin cambios.
+        #con skip_unchanged se descartan antes del MERGE los registros identicos a los de la tabla destino,
+        #sin considerar las columnas de ignore_columns (p. ej. marcas de actualizacion)
+
+        keys = self.primary_key_columns(primary_key)
+
+        df = df.drop_duplicates(subset=keys,keep='last')
+
+        columns = list(df.columns)
+
+        values = [c for c in columns if c not in keys]
+
+        quote = self.engine.dialect.identifier_preparer.quote
+
+        try:
+
+            with self.engine.begin() as c:
+
+                table = self.get_table(table_name)
+
+                staging = self.create_staging_table(c,table,columns)
+
+                self.insert_rows(c, staging, df)
+
+                target = quote(table.name)
+                source = quote(staging.name)
+
+                on = self.join_condition('t',source,keys)
+
+                unchanged = 0
+
+                if skip_unchanged:
+
+                    compared = [col for col in values if col not in ignore_columns]
+
+                    unchanged = c.execute(text(f'DELETE FROM {source} WHERE EXISTS (SELECT 1 FROM {target} t WHERE {on} AND NOT {self.changed_condition("t",source,compared)})')).rowcount
+
+                updated = c.execute(text(f'SELECT COUNT(*) FROM {source} WHERE EXISTS (SELECT 1 FROM {target} t WHERE {on})')).scalar()
+
+                inserted = len(df) - unchanged - updated
+
+                column_list = ', '.join(quote(col) for col in columns)
+
+                if self.engine_type == 'mssql':
+
+                    statement = f'MERGE INTO {target} WITH (HOLDLOCK) AS t USING {source} AS s ON {self.join_condition("t","s",keys)} '
+
+                    if values:
+
+                        statement += 'WHEN MATCHED THEN UPDATE SET ' + ', '.join(f't.{quote(col)} = s.{quote(col)}' for col in values) + ' '
+
+                    statement += f'WHEN NOT MATCHED THEN INSERT ({column_list}) VALUES (' + ', '.join(f's.{quote(col)}' for col in columns) + ');'
+
+                elif self.engine_type == 'sqlite':
+
+                    statement = f'INSERT INTO {target} ({column_list}) SELECT {column_list} FROM {source} WHERE true ON CONFLICT ({", ".join(quote(k) for k in keys)}) '
+
+                    if values:
+
+                        statement += 'DO UPDATE SET ' + ', '.join(f'{quote(col)} = excluded.{quote(col)}' for col in values)
+
+                    else:
+
+                        statement += 'DO NOTHING'
+
+                if inserted or updated:
+
+                    c.execute(text(statement))
+
+                c.execute(text(f'DROP TABLE {source}'))
+
+            print(f'Se actualizaron correctamente los registros de la tabla {table_name}. Se añadieron {inserted} registros y se modificaron {updated} registros.')
+
+            return {
+
+                'insert' : inserted,
+                'update' : updated,
+                'unchanged' : unchanged
+            }
+
+        except Exception as e:
+
+            raise SQLAlchemyError(f'Error al intentar actualizar registros en la tabla {table_name}: {e}')
+
+    def diff_from_df(self, table_name, df, primary_key, compare=True, ignore_columns=()):
+
+        #envia los registros a una tabla temporal y obtiene del servidor la particion entre registros nuevos y existentes,
+        #sin descargar las llaves de la tabla destino. Con compare, los registros existentes identicos a los de la tabla
+        #destino se descartan y solo se devuelven los modificados
+
+        keys = self.primary_key_columns(primary_key)
+
+        df = df.drop_duplicates(subset=keys,keep='last').reset_index(drop=True)
+
+        columns = list(df.columns)
+
+        compared = [col for col in columns if col not in keys and col not in ignore_columns]
+
+        quote = self.engine.dialect.identifier_preparer.quote
+
+        try:
+
+            with self.engine.begin() as c:
+
+                table = self.get_table(table_name)
+
+                staging = self.create_staging_table(c,table,columns,row_number=True)
+
+                self.insert_rows(c, staging, df.assign(stage_row=range(len(df))))
+
+                target = quote(table.name)
+                source = quote(staging.name)
+
+                if compare and compared:
+
+                    changed = f'CASE WHEN {self.changed_condition("t",source,compared)} THEN 1 ELSE 0 END'
+
+                else:
+
+                    changed = '1'
+
+                r = c.execute(text(f'SELECT {source}.stage_row, {changed} FROM {source} JOIN {target} t ON {self.join_condition("t",source,keys)}')).fetchall()
+
+                c.execute(text(f'DROP TABLE {source}'))
+
+        except Exception as e:
+
+            raise SQLAlchemyError(f'Error al comparar registros con la tabla {table_name}: {e}')
+
+        existing = [row[0] for row in r]
+
+        modified = [row[0] for row in r if row[1]]
+
+        return {
+
+            'insert' : df.drop(index=existing),
+            'update' : df.loc[sorted(modified)]
+        }
+
+    @staticmethod
+    def primary_key_columns(primary_key):
+
+        if isinstance(primary_key,str):
+
+            return [primary_key]
+
+        elif isinstance(primary_key,(list,tuple)):
+
+            return list(primary_key)
+
+        else:
+            raise ValueError('Invalid data type for parameter primary key: it must be a str or a tuple/list')
+
+    def join_condition(self, target, source, keys):
+
+        quote = self.engine.dialect.identifier_preparer.quote
+
+        return ' AND '.join(f'{target}.{quote(k)} = {source}.{quote(k)}' for k in keys)
+
+    def changed_condition(self, target, source, columns):
+
+        #comparacion de filas que trata los NULL como iguales, valida tanto en SQL Server como en sqlite
+
+        if not columns:
+
+            return '(1 = 0)'
+
+        quote = self.engine.dialect.identifier_preparer.quote
+
+        return f'EXISTS (SELECT {", ".join(f"{source}.{quote(col)}" for col in columns)} EXCEPT SELECT {", ".join(f"{target}.{quote(col)}" for col in columns)})'
+
+    def create_staging_table(self, connection, table, columns, row_number=False):
+
+        #tabla temporal con las columnas y tipos de la tabla destino, visible solo en la conexion actual
 
         if self.engine_type == 'mssql':
 
-            r = self.execute_query(f'''SELECT COLUMN_NAME
-                                FROM INFORMATION_SCHEMA.COLUMNS
-                               WHERE TABLE_NAME = '{table}'
-                                 ''')
-            return [row[0] for row in r]
-            
+            name = f'#stage_{table.name}'
+
         elif self.engine_type == 'sqlite':
 
-            r = f'''
-                PRAGMA table_info({table}
-            '''
-            return [row['name'] for row in r]
+            name = f'stage_{table.name}'
+
+        staging_columns = [Column(col, table.c[col].type) for col in columns]
+
+        if row_number:
+
+            staging_columns.append(Column('stage_row', Integer))
+
+        staging = Table(name, MetaData(), *staging_columns, prefixes=['TEMPORARY'] if self.engine_type == 'sqlite' else [])
+
+        connection.execute(text(f'DROP TABLE IF EXISTS {self.engine.dialect.identifier_preparer.quote(name)}'))
+
+        staging.create(connection)
+
+        return staging
+
+    #consultas con el nombre de la tabla como parametro, el texto de la sentencia no cambia entre ejecuciones
+
+    COLUMNS_QUERY = {
+
+        'mssql' : text('SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = :table ORDER BY ORDINAL_POSITION').bindparams(bindparam('table')),
+        'sqlite' : text('SELECT name FROM pragma_table_info(:table) ORDER BY cid').bindparams(bindparam('table'))
+    }
+
+    def get_columns_from_table(self, table):
+
+        r = self.execute_query(self.COLUMNS_QUERY[self.engine_type].params(table=table))
+
+        return [row[0] for row in r]
     
     def get_last_update(self, table,time_column):
 
-        r = self.execute_query(f"SELECT MAX({time_column}) FROM {table}")
+        table = self.get_table(table)
+
+        r = self.execute_query(select([func.max(table.c[time_column])]))
         if r:
             return r[0][0] or 0
         else:
@@ -145,32 +563,29 @@ class SQLServerEngine:
 
     def get_last_visit_date(self,table,column):
 
-        subquery = f'SELECT MAX({column}) FROM {table}'
+        table = self.get_table(table)
+
+        subquery = select([func.max(table.c[column])]).scalar_subquery()
 
-        query = f'{subquery} WHERE {column} < ({subquery})' 
+        query = select([func.max(table.c[column])]).where(table.c[column] < subquery)
 
         r = self.execute_query(query)
 
-        if self.engine_type == 'mssql':
+        last_date = r[0][0] if r else None
 
-            if r:
-                return r[0][0] or datetime(2023,11,1)
-        
-            else:
-                return datetime(2023,11,1)
-        
-        if self.engine_type == 'sqlite':
+        if last_date is None:
 
-            if r:
-                return datetime.strptime(r[0][0], '%Y-%m-%d') or datetime(2023,11,1)
-            
-            else:
-                return datetime(2023,11,1)
+            return datetime(2023,11,1)
+
+        if isinstance(last_date,str):
+
+            return datetime.strptime(last_date, '%Y-%m-%d')
+
+        return last_date
     
     def select_values(self,table,columns):
 
-        metadata = MetaData()
-        table = Table(table,metadata,autoload=True,autoload_with=self.engine)
+        table = self.get_table(table)
 
         query = select([table.c[column] for column in columns])
         
@@ -0,0 +1,178 @@
+import sys
+from os.path import abspath, join, dirname
+project_dir = abspath(join(dirname(__file__), '..'))
+sys.path.insert(0, project_dir)
+
+from io import BytesIO
+from threading import Thread
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pandas import DataFrame
+from utils.utilities import VISIT_PANEL_PAGE_IDS
+
+
+#servidor local que reproduce el contrato de la aplicacion web de Involves que usa InvolvesWebClient:
+#
+#   POST /login (formulario username, password)
+#       credenciales validas: 302 a /webapp con la cookie JSESSIONID
+#       credenciales invalidas: 302 de vuelta a /login, con una cookie que no es de sesion
+#
+#   GET /webapp/visitpanel/report/export?pageId=&startDate=d/m/aa[&endDate=d/m/aa]&report=report.custom.columns&showHiddenColumns=true
+#       con sesion: 200 y el informe gerencial en XLSX
+#       sin sesion o sesion expirada: 302 a /login, que responde la pagina HTML de inicio de sesion
+#       parametros invalidos: 400
+#
+#el formulario de inicio de sesion, la ruta de exportacion y sus parametros no estan confirmados contra la aplicacion
+#real: este servidor implementa las mismas suposiciones que InvolvesWebClient, por lo que las pruebas no validan el
+#contrato. Hay que capturar las llamadas reales (traza de red del navegador) y ajustar el cliente y este archivo a ellas
+#antes de usar la exportacion por HTTP en los flujos de produccion
+
+USERNAME = 'usuario'
+PASSWORD = 'secreto'
+SESSION = 'sesion-valida'
+
+VISITS = [
+
+    {
+        'Fecha de la visita' : '01/02/2024',
+        'ID del PDV' : '101',
+        'Regional' : 'Norte',
+        'Empleado' : 'Ana',
+        'Tipo de check-in' : 'GPS',
+        'Primer check-in manual' : '01/02/2024 09:15:00',
+        'Último check-out manual' : '01/02/2024 10:05:00',
+        'Total de encuestas respondidas' : 2,
+        'Motivo para no realizar la visita' : None
+    },
+    {
+        'Fecha de la visita' : '02/02/2024',
+        'ID del PDV' : '102',
+        'Regional' : 'Sur',
+        'Empleado' : 'Luis',
+        'Tipo de check-in' : 'Manual',
+        'Primer check-in manual' : None,
+        'Último check-out manual' : None,
+        'Total de encuestas respondidas' : 0,
+        'Motivo para no realizar la visita' : 'Cerrado'
+    }
+]
+
+
+def visits_report():
+
+    buffer = BytesIO()
+
+    DataFrame(VISITS).to_excel(buffer, index=False)
+
+    return buffer.getvalue()
+
+
+class InvolvesStubHandler(BaseHTTPRequestHandler):
+
+    #sesiones validas, se comparten entre solicitudes del mismo servidor
+
+    sessions = set()
+
+    #solicitudes de exportacion recibidas, para revisar los parametros enviados por el cliente
+
+    exports = []
+
+    def do_POST(self):
+
+        url = urlparse(self.path)
+
+        if url.path != '/login':
+
+            return self.send_error(404)
+
+        form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+
+        if form.get('username') == [USERNAME] and form.get('password') == [PASSWORD]:
+
+            self.sessions.add(SESSION)
+
+            self.redirect('/webapp', f'JSESSIONID={SESSION}; Path=/')
+
+        else:
+
+            self.redirect('/login', 'locale=es; Path=/')
+
+    def do_GET(self):
+
+        url = urlparse(self.path)
+
+        if url.path == '/login':
+
+            return self.respond(200, 'text/html', b'<html><form id="login"></form></html>')
+
+        if url.path == '/webapp':
+
+            return self.respond(200, 'text/html', b'<html>webapp</html>')
+
+        if url.path != '/webapp/visitpanel/report/export':
+
+            return self.send_error(404)
+
+        if self.session() not in self.sessions:
+
+            return self.redirect('/login')
+
+        params = {k : v[0] for k, v in parse_qs(url.query).items()}
+
+        self.exports.append(params)
+
+        if params.get('pageId') not in VISIT_PANEL_PAGE_IDS.values() or 'startDate' not in params or params.get('report') != 'report.custom.columns':
+
+            return self.send_error(400)
+
+        self.respond(200, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', visits_report())
+
+    def session(self):
+
+        cookies = dict(_.strip().split('=', 1) for _ in (self.headers.get('Cookie') or '').split(';') if '=' in _)
+
+        return cookies.get('JSESSIONID')
+
+    def redirect(self, location, cookie=None):
+
+        self.send_response(302)
+        self.send_header('Location', location)
+
+        if cookie:
+            self.send_header('Set-Cookie', cookie)
+
+        self.end_headers()
+
+    def respond(self, status, content_type, body):
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+
+        pass
+
+
+def start_stub_server(port=0):
+
+    #inicia el servidor en un hilo y devuelve (servidor, base_url); con port=0 se usa un puerto libre
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), InvolvesStubHandler)
+
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+if __name__ == '__main__':
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+
+    server, base_url = start_stub_server(port)
+
+    print(f'Servidor de prueba de Involves en {base_url}')
+
+    server.serve_forever()
@@ -0,0 +1,94 @@
+import sys
+from os.path import abspath, join, dirname
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+sys.path.insert(0, dirname(__file__))
+
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from involves_stub_server import start_stub_server, InvolvesStubHandler, USERNAME, PASSWORD
+from src.involves_web_client import InvolvesWebClient, InvolvesSessionError
+from utils.retry_handlers import visit_bot_retry_fn
+
+
+@pytest.fixture
+def base_url():
+
+    server, url = start_stub_server()
+
+    InvolvesStubHandler.sessions.clear()
+    InvolvesStubHandler.exports.clear()
+
+    yield url
+
+    server.shutdown()
+
+
+def test_download_visits(base_url):
+
+    client = InvolvesWebClient(1, 'dkt', USERNAME, PASSWORD, base_url=base_url)
+
+    df = client.download_visits(date(2024, 2, 1), date(2024, 2, 7))
+
+    assert InvolvesStubHandler.exports[-1]['startDate'] == '1/2/24'
+    assert InvolvesStubHandler.exports[-1]['endDate'] == '7/2/24'
+    assert list(df['ID del PDV']) == [101, 102]
+    assert list(df['Fecha de la visita']) == [date(2024, 2, 1), date(2024, 2, 2)]
+
+
+def test_invalid_credentials(base_url):
+
+    client = InvolvesWebClient(1, 'dkt', USERNAME, 'incorrecta', base_url=base_url)
+
+    with pytest.raises(PermissionError):
+
+        client.login()
+
+
+def test_expired_session_is_retried(base_url):
+
+    client = InvolvesWebClient(1, 'dkt', USERNAME, PASSWORD, base_url=base_url)
+
+    client.login()
+
+    InvolvesStubHandler.sessions.clear()
+
+    with pytest.raises(InvolvesSessionError) as error:
+
+        client.export_visits(date(2024, 2, 1))
+
+    class State:
+
+        def result(self):
+
+            raise error.value
+
+    assert visit_bot_retry_fn(None, None, State())
+
+    assert not client.logged_in
+
+    assert len(client.download_visits(date(2024, 2, 1))) == 2
+
+
+def test_concurrent_exports_share_one_login(base_url):
+
+    client = InvolvesWebClient(1, 'dkt', USERNAME, PASSWORD, base_url=base_url)
+
+    logins = []
+
+    login = client.login
+
+    def counted_login():
+
+        logins.append(1)
+
+        login()
+
+    client.login = counted_login
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+
+        results = list(executor.map(lambda day: client.download_visits(date(2024, 2, day)), range(1, 9)))
+
+    assert len(logins) == 1
+    assert all(len(_) == 2 for _ in results)
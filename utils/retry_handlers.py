@@ -1,9 +1,14 @@
+from requests import RequestException
+from selenium.common.exceptions import WebDriverException
+
 def visit_bot_retry_fn(task,task_run,state):
     
     try:
         state.result()
 
-    except FileNotFoundError:
+    #WebDriverException cubre los fallos al abrir el navegador, que ocurren fuera del manejo de errores de download_visits
+
+    except (FileNotFoundError, RequestException, WebDriverException):
 
         return True
     
@@ -1,7 +1,9 @@
 import requests
 import pandas as pd
 
-from time import sleep
+import re
+import atexit
+from time import sleep, monotonic
 from datetime import datetime
 from functools import reduce
 from selenium import webdriver
@@ -9,11 +11,15 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 
-from os import remove
-from os.path import join
+from os import remove, makedirs
+from os.path import join, exists, getsize, expanduser
+from threading import Lock
 from base64 import b64encode
 from tempfile import mkdtemp
-from numpy import isnan
+from numpy import isnan, nan
+from zipfile import ZipFile
+from xml.etree import ElementTree
+from xml.etree.ElementTree import iterparse
 
 def basic_auth(username,password):
     
@@ -146,7 +152,7 @@ def last_survey_from_query(sql_connection,form_id,table):
 
         with conn.cursor() as cursor:
 
-            cursor.execute(f'SELECT MAX(survey_id) AS last_survey FROM {table} WHERE form_id = {form_id}')
+            cursor.execute(f'SELECT MAX(survey_id) AS last_survey FROM {table} WHERE form_id = ?',form_id)
             last_survey = cursor.fetchall()
     
     last_survey = last_survey[0][0]
@@ -187,95 +193,306 @@ def set_null_values(value):
     return value
 
 
-def download_visits(username,password,date,env,domain,wait=10,download_folder=None,headless_mode=False,file_name='informe-gerencial-visitas.xlsx'):
-    
-    if download_folder is None:
-        download_folder = mkdtemp()
+def normalize_null_values(df):
 
-    visits = join(download_folder,file_name)
-    
+    #version vectorizada de df.map(set_null_values).replace({nan:None}): diccionarios, cadenas vacias y NaN/NaT
+    #se convierten en None columna por columna. Las columnas sin valores nulos conservan su tipo original
+
+    df = df.copy()
+
+    for column in df.columns:
+
+        series = df[column]
+
+        mask = series.isna()
+
+        if series.dtype == object:
+
+            mask |= series.eq('') | series.map(type).eq(dict)
+
+        if mask.any():
+
+            df[column] = series.astype(object).where(~mask, None)
+
+    return df
+
+
+#identificador del panel de visitas de la aplicacion web para cada ambiente
+
+VISIT_PANEL_PAGE_IDS = {
+
+    1 : 'Mflfx4vR~2FUIfTPLg5S4O8Q==',
+    5 : 'czEU~2FKSKS0bUKeGe5uBOwQ=='
+}
+
+
+#la sesion de Involves se conserva entre procesos en un perfil de Chrome por dominio y usuario (--user-data-dir),
+#de modo que cada ejecucion programada, que inicia un proceso nuevo, abre el navegador con la sesion ya iniciada.
+#dentro del mismo proceso, ademas, los navegadores abiertos se reutilizan entre ejecuciones
+
+PROFILES_FOLDER = join(expanduser('~'),'.involves_chrome_profiles')
+
+_browsers = {}
+_profiles_in_use = set()
+_browsers_lock = Lock()
+
+
+def get_browser(username,password,domain,download_folder=None,headless_mode=False,profiles_folder=PROFILES_FOLDER):
+
+    #devuelve el navegador del pool para el dominio y usuario, o abre uno nuevo con el perfil persistente;
+    #mientras el navegador este en uso se retira del pool, de modo que dos descargas concurrentes no compartan la misma ventana.
+    #Chrome no permite abrir el mismo perfil dos veces, si el perfil ya esta en uso (en este u otro proceso) el navegador nuevo usa un perfil temporal
+
+    key = (domain,username,headless_mode)
+
+    with _browsers_lock:
+
+        browser = _browsers.pop(key,None)
+
+    if browser is not None:
+
+        driver, folder, profile = browser
+
+        try:
+
+            driver.current_url
+
+            return driver, folder, profile
+
+        except Exception:
+
+            close_browser(driver,profile)
+
+    profile = join(profiles_folder,re.sub(r'[^\w.-]','_',f'{domain}_{username}'))
+
+    with _browsers_lock:
+
+        if profile in _profiles_in_use:
+
+            profile = None
+
+        else:
+
+            _profiles_in_use.add(profile)
+
+    folder = download_folder or mkdtemp()
+
+    print(f"Iniciando proceso de descarga en https://{domain}.involves.com")
+
+    #abrir el navegador
     try:
-        print(f"Iniciando proceso de descarga en https://{domain}.involves.com/login")
-        chrome_options = webdriver.ChromeOptions()
-        prefs = {"download.default_directory" : f'{download_folder}'}
-        chrome_options.add_experimental_option("prefs",prefs)
-
-        if headless_mode:
-            
-            #Abrir Chrome sin interfaz gráfica
-            chrome_options.add_argument('--headless')
-            #Deshabilitar GPU
-            chrome_options.add_argument('--disable-gpu')
-        
-        #abrir el navegador
-        driver = webdriver.Chrome(options=chrome_options)      
-        driver.get(f'https://{domain}.involves.com/login')
-        driver.implicitly_wait(10) #10 segundos máximos de espera, de lo contrario devuelve exception
-
-        # Esperar el inputbox 'username' 
-        username_input = WebDriverWait(driver, 10).until(
-            EC.element_to_be_clickable((By.ID, 'username'))
-        )
-        username_input.clear()
-        username_input.send_keys(username)
 
-        # Esperar el inputbox 'password'
-        password_input = WebDriverWait(driver, 10).until(
-        EC.element_to_be_clickable((By.ID, 'password'))
-        )
-        password_input.clear()
-        password_input.send_keys(password)  
+        driver = webdriver.Chrome(options=chrome_options(folder,profile,headless_mode))
+
+    except Exception as e:
+
+        release_profile(profile)
+
+        if profile is None:
 
-        print("Inicio de Sesión satisfactorio")
-        # esperar el submit-button
+            raise
+
+        #_profiles_in_use solo cubre este proceso: otra ejecucion del flujo o un Chrome que quedo abierto pueden tener el
+        #perfil persistente ("user data directory is already in use"), en ese caso se usa un perfil temporal y se inicia sesion de nuevo
+
+        print(f"No se pudo abrir el perfil persistente {profile}, se usa un perfil temporal: {e}")
+
+        profile = None
+
+        driver = webdriver.Chrome(options=chrome_options(folder,profile,headless_mode))
+
+    return driver, folder, profile
+
+
+def chrome_options(folder,profile=None,headless_mode=False):
+
+    #opciones de Chrome con la carpeta de descargas y, si se indica, el perfil persistente
+
+    options = webdriver.ChromeOptions()
+    prefs = {"download.default_directory" : f'{folder}'}
+    options.add_experimental_option("prefs",prefs)
+
+    if profile is not None:
+
+        makedirs(profile,exist_ok=True)
+        options.add_argument(f'--user-data-dir={profile}')
+
+    if headless_mode:
         
-        login_button = WebDriverWait(driver, 10).until(
-            EC.element_to_be_clickable((By.CLASS_NAME, 'inv-btn.submit-button'))
-        )
-        login_button.click()
+        #Abrir Chrome sin interfaz gráfica
+        options.add_argument('--headless')
+        #Deshabilitar GPU
+        options.add_argument('--disable-gpu')
+
+    return options
+
+
+def release_browser(driver,folder,profile,username,domain,headless_mode=False):
+
+    #devuelve el navegador al pool; si otra descarga concurrente ya devolvio uno para la misma llave, se cierra este
+
+    with _browsers_lock:
+
+        key = (domain,username,headless_mode)
+
+        if key not in _browsers:
+
+            _browsers[key] = (driver,folder,profile)
+
+            return
+
+    close_browser(driver,profile)
+
+
+def release_profile(profile):
+
+    with _browsers_lock:
+
+        _profiles_in_use.discard(profile)
+
+
+def close_browser(driver,profile=None):
+
+    try:
+        driver.quit()
+
+    except Exception:
+        pass
+
+    release_profile(profile)
+
+
+@atexit.register
+def close_browsers():
+
+    with _browsers_lock:
+
+        browsers = list(_browsers.values())
+
+        _browsers.clear()
+
+    for driver, _, profile in browsers:
+
+        close_browser(driver,profile)
+
+
+def open_visit_panel(driver,username,password,domain,page_id,timeout=10):
+
+    #abre el panel de visitas; si la sesion del perfil no existe o expiro la aplicacion redirige al login,
+    #en ese caso se inicia sesion y se vuelve a abrir el panel
+
+    panel = f'https://{domain}.involves.com/webapp/#!/app/{page_id}/paineldevisitas'
+
+    driver.get(panel)
+
+    WebDriverWait(driver, timeout).until(
+        lambda d: '/login' in d.current_url or d.find_elements(By.CLASS_NAME, 'c-input')
+    )
+
+    if '/login' in driver.current_url:
+
+        login(driver,username,password,domain,timeout)
+
+        driver.get(panel)
 
-        sleep(5)
 
-        #ir al panel de visitas
-        if env == 5:
-            page_id = 'czEU~2FKSKS0bUKeGe5uBOwQ=='
+def login(driver,username,password,domain,timeout=10):
 
-        if env == 1:
-            page_id = 'Mflfx4vR~2FUIfTPLg5S4O8Q=='
+    driver.get(f'https://{domain}.involves.com/login')
 
-        driver.get(f'https://{domain}.involves.com/webapp/#!/app/{page_id}/paineldevisitas')
+    # Esperar el inputbox 'username' 
+    username_input = WebDriverWait(driver, timeout).until(
+        EC.element_to_be_clickable((By.ID, 'username'))
+    )
+    username_input.clear()
+    username_input.send_keys(username)
+
+    # Esperar el inputbox 'password'
+    password_input = WebDriverWait(driver, timeout).until(
+    EC.element_to_be_clickable((By.ID, 'password'))
+    )
+    password_input.clear()
+    password_input.send_keys(password)  
+
+    # esperar el submit-button
+    login_button = WebDriverWait(driver, timeout).until(
+        EC.element_to_be_clickable((By.CLASS_NAME, 'inv-btn.submit-button'))
+    )
+    login_button.click()
+
+    #la sesion queda iniciada cuando la aplicacion sale de la pagina de login
+    WebDriverWait(driver, timeout).until(lambda d: '/login' not in d.current_url)
+
+    print("Inicio de Sesión satisfactorio")
+
+
+def wait_for_download(file_path,timeout=60,poll_frequency=0.5):
+
+    #espera a que el archivo exista y su tamaño no cambie entre dos revisiones consecutivas, sin descargas parciales de Chrome
+
+    deadline = monotonic() + timeout
+    last_size = -1
+
+    while monotonic() < deadline:
+
+        if exists(file_path) and not exists(f'{file_path}.crdownload'):
+
+            size = getsize(file_path)
+
+            if size > 0 and size == last_size:
+
+                return file_path
+
+            last_size = size
+
+        sleep(poll_frequency)
+
+    raise FileNotFoundError(f'No se completó la descarga de {file_path} en {timeout} segundos')
+
+
+def download_visits(username,password,date,env,domain,wait=60,download_folder=None,headless_mode=False,file_name='informe-gerencial-visitas.xlsx',timeout=30):
+
+    #wait es el tiempo maximo de espera de la descarga y timeout el de cada elemento de la pagina;
+    #download_folder solo aplica cuando se crea un navegador nuevo para el pool
+
+    driver, folder, profile = get_browser(username,password,domain,download_folder,headless_mode)
+
+    visits = join(folder,file_name)
+
+    if exists(visits):
+        remove(visits)
+
+    try:
+
+        #ir al panel de visitas, iniciando sesion solo si el perfil no tiene una sesion valida
+        open_visit_panel(driver,username,password,domain,VISIT_PANEL_PAGE_IDS[env],timeout)
         
         #Esperar el filtro de fecha
-        input_element = WebDriverWait(driver,10).until(
-            EC.presence_of_element_located((By.CLASS_NAME, 'c-input'))
+        input_element = WebDriverWait(driver,timeout).until(
+            EC.element_to_be_clickable((By.CLASS_NAME, 'c-input'))
             )
         input_element.clear()
         input_element.send_keys(format_involves_date(date))
-        sleep(2)
-        button_element = WebDriverWait(driver,10).until(
-            EC.presence_of_element_located((By.XPATH,'//ap-button[@identifier="searchAggregatorFilter"]')
+        button_element = WebDriverWait(driver,timeout).until(
+            EC.element_to_be_clickable((By.XPATH,'//ap-button[@identifier="searchAggregatorFilter"]')
             ))
         button_element.click()
-        sleep(10)
         #esperar el dropdown-toggle-button 'opciones'
-        button_element = WebDriverWait(driver, 10).until(
+        button_element = WebDriverWait(driver, timeout).until(
             EC.element_to_be_clickable((By.CSS_SELECTOR, 'button.dropdown-toggle'))
         )
 
         #click en 'opciones' y luego en 'informe gerencial'
         button_element.click()
-        sleep(1)
-        driver.implicitly_wait(15)
-        li_element = WebDriverWait(driver, 10).until(
+        li_element = WebDriverWait(driver, timeout).until(
         EC.element_to_be_clickable((By.XPATH, '//li[@label="\'report.custom.columns\'"]'))
         ) 
         li_element.click()
     
         #Esperar el modal
-        modal_content_element = WebDriverWait(driver, 10).until(
-        EC.presence_of_element_located((By.CLASS_NAME, 'modal-content'))
+        WebDriverWait(driver, timeout).until(
+        EC.visibility_of_element_located((By.CLASS_NAME, 'modal-content'))
         )
-        sleep(1)
         #Elegir celdas ocultas en caso de que existan
         try:
 
@@ -288,47 +505,194 @@ def download_visits(username,password,date,env,domain,wait=10,download_folder=No
 
             pass
 
-        sleep(2)
         #Cuando el modal se ha cargado, esperar el boton 'confirmar'
-        confirm_button = WebDriverWait(driver, 10).until(
+        confirm_button = WebDriverWait(driver, timeout).until(
         EC.element_to_be_clickable((By.XPATH, '//button[contains(., "Confirmar")]'))
         )
         confirm_button.click()
 
-        sleep(wait)
+        wait_for_download(visits,timeout=wait)
 
         print("Descarga de visitas satisfactoria")
 
+        release_browser(driver,folder,profile,username,domain,headless_mode)
 
     except Exception as e:
+
+        #ante cualquier error el navegador se descarta, el siguiente intento inicia uno nuevo
         print(f"Error en la función download_visits: {e}")
-    
+        close_browser(driver,profile)
 
-    finally:
-        driver.quit()
-        df = pd.read_excel(visits)
-        remove(visits)
+    df = read_visits_report(visits,env)
+    remove(visits)
 
-        if env == 5:
-            df['Fecha de la visita'] = pd.to_datetime(df['Fecha de la visita'],format="%d/%m/%Y").dt.date
-            df['ID del PDV'] = pd.to_numeric(df['ID del PDV'])
-            df['Regional'] = df['Regional'].astype(str)
-            df['Tipo de check-in'] = df['Tipo de check-in'].astype(str)
-            df['Primer check-in manual'] = pd.to_datetime(df['Primer check-in manual'],format='%d/%m/%Y %H:%M:%S',errors='coerce')
-            df['Último check-out manual'] = pd.to_datetime(df['Último check-out manual'],format='%d/%m/%Y %H:%M:%S',errors='coerce')
+    return df
 
-            df = df[['Fecha de la visita','ID del PDV','Regional','Tipo de check-in',
-                     'Primer check-in manual','Último check-out manual']]
-        
-        if env == 1:
-            df['Fecha de la visita'] = pd.to_datetime(df['Fecha de la visita'],format="%d/%m/%Y").dt.date
-            df['ID del PDV'] = pd.to_numeric(df['ID del PDV'])
-            df['Regional'] = df['Regional'].astype(str)
-            df['Tipo de check-in'] = df['Tipo de check-in'].astype(str)
-            df['Primer check-in manual'] = pd.to_datetime(df['Primer check-in manual'],format='%d/%m/%Y %H:%M:%S',errors='coerce')
-            df['Último check-out manual'] = pd.to_datetime(df['Último check-out manual'],format='%d/%m/%Y %H:%M:%S',errors='coerce')
-
-            df = df[['Fecha de la visita','ID del PDV','Empleado','Tipo de check-in','Primer check-in manual',
-                     'Último check-out manual','Total de encuestas respondidas','Motivo para no realizar la visita']]
+
+#columnas del informe gerencial de visitas por ambiente, en el orden de la tabla destino, y el tipo al que se convierten:
+#date y datetime con el formato de fecha de Involves, int numerico, str texto y None sin conversion
+
+VISIT_REPORT_COLUMNS = {
+
+    1 : {
+        'Fecha de la visita' : 'date',
+        'ID del PDV' : 'int',
+        'Empleado' : None,
+        'Tipo de check-in' : 'str',
+        'Primer check-in manual' : 'datetime',
+        'Último check-out manual' : 'datetime',
+        'Total de encuestas respondidas' : None,
+        'Motivo para no realizar la visita' : None
+    },
+
+    5 : {
+        'Fecha de la visita' : 'date',
+        'ID del PDV' : 'int',
+        'Regional' : 'str',
+        'Tipo de check-in' : 'str',
+        'Primer check-in manual' : 'datetime',
+        'Último check-out manual' : 'datetime'
+    }
+}
+
+
+def read_visits_report(source,env):
+
+    #lee solo las columnas del informe que usa el ambiente recorriendo la hoja como XML en flujo, sin cargar el libro
+    #completo con read_excel ni crear un objeto por celda; source puede ser una ruta o un archivo en memoria
+
+    spec = VISIT_REPORT_COLUMNS[env]
+
+    rows = iter_xlsx_rows(source)
+
+    header = next(rows)
+
+    positions = {header[column] : column for column in header if header[column] in spec}
+
+    #una columna ausente (p. ej. renombrada en Involves) dejaria la columna vacia y todas las filas se descartarian al limpiar
+
+    missing = [column for column in spec if column not in positions]
+
+    if missing:
+
+        raise ValueError(f'El informe de visitas no contiene las columnas {missing} del ambiente {env}')
+
+    values = {column : [] for column in spec}
+
+    for row in rows:
+
+        for name, column in positions.items():
+
+            values[name].append(row.get(column))
+
+    return format_visits(pd.DataFrame({column : pd.Series(v,dtype=object) for column, v in values.items()}),env)
+
+
+def iter_xlsx_rows(source):
+
+    #generador de las filas de la primera hoja de un archivo XLSX como diccionarios {columna (A, B, ...) : valor};
+    #los textos se resuelven con la tabla de cadenas compartidas y los numeros se devuelven como int o float.
+    #las fechas con formato numerico de Excel no se convierten: el informe de Involves las exporta como texto
+
+    ns = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+    rel_ns = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+
+    with ZipFile(source) as workbook:
+
+        names = set(workbook.namelist())
+
+        shared_strings = []
+
+        if 'xl/sharedStrings.xml' in names:
+
+            with workbook.open('xl/sharedStrings.xml') as file:
+
+                for _, element in iterparse(file):
+
+                    if element.tag == f'{ns}si':
+
+                        shared_strings.append(''.join(t.text or '' for t in element.iter(f'{ns}t')))
+                        element.clear()
+
+        #ruta de la primera hoja segun workbook.xml y sus relaciones
+
+        sheet_id = ElementTree.parse(workbook.open('xl/workbook.xml')).find(f'{ns}sheets/{ns}sheet').get(f'{rel_ns}id')
+
+        relations = ElementTree.parse(workbook.open('xl/_rels/workbook.xml.rels')).getroot()
+
+        target = next(r.get('Target') for r in relations if r.get('Id') == sheet_id)
+
+        sheet = target.lstrip('/') if target.startswith('/') else f'xl/{target}'
+
+        with workbook.open(sheet) as file:
+
+            row = {}
+
+            for _, element in iterparse(file):
+
+                if element.tag == f'{ns}c':
+
+                    column = element.get('r').rstrip('0123456789')
+
+                    kind = element.get('t')
+
+                    if kind == 'inlineStr':
+
+                        value = ''.join(t.text or '' for t in element.iter(f'{ns}t'))
+
+                    else:
+
+                        value = element.findtext(f'{ns}v')
+
+                        if value is not None:
+
+                            if kind == 's':
+                                value = shared_strings[int(value)]
+
+                            elif kind == 'b':
+                                value = value == '1'
+
+                            elif kind in (None, 'n'):
+                                value = float(value)
+                                value = int(value) if value.is_integer() else value
+
+                    #las celdas con texto vacio se tratan como vacias, igual que en read_excel
+
+                    row[column] = None if value == '' else value
+
+                elif element.tag == f'{ns}row':
+
+                    yield row
+
+                    row = {}
+
+                    element.clear()
+
+
+def format_visits(df,env):
+
+    #tipos y columnas del informe gerencial de visitas segun el ambiente
+
+    spec = VISIT_REPORT_COLUMNS[env]
+
+    df = df[list(spec)].copy()
+
+    for column, kind in spec.items():
+
+        if kind == 'date':
+            df[column] = pd.to_datetime(df[column],format="%d/%m/%Y").dt.date
+
+        elif kind == 'datetime':
+            df[column] = pd.to_datetime(df[column],format='%d/%m/%Y %H:%M:%S',errors='coerce')
+
+        elif kind == 'int':
+            df[column] = pd.to_numeric(df[column])
+
+        elif kind == 'str':
+            #las celdas vacias se convierten a 'nan', igual que al leer el informe con read_excel
+            df[column] = df[column].fillna(nan).astype(str)
+
+        elif df[column].dtype == object:
+            df[column] = df[column].fillna(nan)
 
     return df